@@ -20,9 +20,39 @@ import sublime_plugin
 import subprocess
 import urllib.parse
 import html
-import random
+import codecs
+import io
+import glob
+import gzip
+import collections
+import json
+import itertools
 import tempfile
 import _thread
+import re
+import select
+import threading
+import time
+import sys
+import errno
+import signal
+import platform
+
+try:
+    import resource
+except ImportError:  # Not on Windows
+    resource = None
+
+try:
+    import cProfile
+    import pstats
+except ImportError:  # Not in every embedded Python
+    cProfile = None
+
+try:
+    import tracemalloc
+except ImportError:  # Not before Python 3.4
+    tracemalloc = None
 
 
 PREFERENCES_FILE = "Preferences.sublime-settings"
@@ -42,6 +72,13 @@ SETTINGS = None  # Initialized by `plugin_loaded`
 #  * `ERRORS_PANEL_NAME`
 #  * `OUTPUT_PANEL_NAME`
 #  * `get_timeout_delay`
+#  * `get_single_argument_fallback`
+#  * `get_limits`
+#  * `Environment`
+#  * `get_diagnostics_writer`
+#  * `get_new_view_writer`
+#  * `Profiler`
+#  * `History`
 #
 #
 # Parameters are interpreted by:
@@ -51,11 +88,18 @@ SETTINGS = None  # Initialized by `plugin_loaded`
 #  * `setup_panels`          for `panels`
 #  * `get_input`             for `source`
 #  * `get_invokation_method` for `through`
+#  * `get_invokation_method` for `fallback`
+#  * `get_limits`            for `limits`
+#  * `OutputFilter`          for `filters`
+#  * `Environment.get`       for `env`
+#  * `get_working_directory` for `cwd`
 #
 #
 # Parameter values are handled by:
 #
+#  * `get_diagnostics_writer`       for `destination:diagnostics`
 #  * `get_insert_replace_writer`    for `destination:insert_replace`
+#  * `get_new_view_writer`          for `destination:new_view`
 #  * `get_nothing_writer`           for `destination` not set
 #  * `get_output_panel_writer`      for `destination:output_panel`
 #  * `get_phantom_writer`           for `destination:phantom`
@@ -69,6 +113,9 @@ SETTINGS = None  # Initialized by `plugin_loaded`
 #  * `invoke_using_nothing`         for `though` not set
 #  * `invoke_using_single_argument` for `though:single_argument`
 #  * `invoke_using_stdin`           for `though:stdin`
+#  * `invoke_using_dev_fd`          for `fallback:dev_fd`
+#  * `get_working_directory` it-self for `cwd`
+#  * `ProjectRoots.find`            for `cwd:nearest:...`
 
 
 # Default when no settings found
@@ -76,6 +123,29 @@ SETTINGS = None  # Initialized by `plugin_loaded`
 DEFAULT_ERRORS_PANEL_NAME = "errors"
 DEFAULT_OUTPUT_PANEL_NAME = "output"
 DEFAULT_TIMEOUT_DELAY = 3  # Seconds, not milliseconds.
+DEFAULT_SINGLE_ARGUMENT_FALLBACK = "temporary_file"
+DEFAULT_DIAGNOSTICS_SCOPE = "invalid"
+DEFAULT_DIAGNOSTICS_ICON = "dot"
+DEFAULT_NEW_VIEW_CHUNK_SIZE = 65536  # Characters
+DEFAULT_NEW_VIEW_SYNTAX = "Packages/Text/Plain text.tmLanguage"
+DEFAULT_PHANTOM_LIMIT = 10
+DEFAULT_PHANTOM_PREVIEW_SIZE = 2000  # Characters
+DEFAULT_PROGRESS_INTERVAL = 100  # Milliseconds
+DEFAULT_SPECULATIVE_DELAY = 1000  # Milliseconds
+DEFAULT_LOGIN_SHELL_ENVIRONMENT = True
+DEFAULT_LOGIN_SHELL_SNAPSHOT = True
+DEFAULT_LOGIN_SHELL_TIMEOUT = 10  # Seconds
+DEFAULT_MAX_OUTPUT = 67108864  # Bytes, output and errors
+DEFAULT_HISTORY_MEMORY = 4194304  # Bytes
+DEFAULT_HISTORY_SIZE = 10  # Results per command
+DEFAULT_PROFILE_DIRECTORY = None  # In the cache, see `Profiler.directory`
+DEFAULT_PROFILE_TOP = 20  # Entries
+
+# Other constants
+# ----------------------------------------------------------------------------
+CHUNK_SIZE = 65536  # Bytes read at once from programs
+TEMPORARY_FILE_PREFIX = "external-programs-"
+TEMPORARY_FILE_SUFFIX = ".temp"
 
 # String constants from Sublime Text
 # ----------------------------------------------------------------------------
@@ -87,31 +157,535 @@ S_SHOW_PANEL = "show_panel"
 # String constants defined for this command
 # ----------------------------------------------------------------------------
 S_ACCUMULATE = "accumulate"
+S_DEV_FD = "dev_fd"
+S_DIAGNOSTICS = "diagnostics"
+S_DIAGNOSTICS_FILE_REGEX = "diagnostics_file_regex"
+S_DIAGNOSTICS_ICON = "diagnostics_icon"
+S_DIAGNOSTICS_LINE_REGEX = "diagnostics_line_regex"
+S_DIAGNOSTICS_SCOPE = "diagnostics_scope"
 S_ERRORS_PANEL_NAME = "errors_panel_name"
+S_FILE_DIR = "file_dir"
 S_FILE_NAME = "file_name"
 S_FILE_URI = "file_uri"
+S_FOLDER = "folder"
+S_HISTORY_MEMORY = "history_memory"
+S_HISTORY_SIZE = "history_size"
 S_INSERT_REPLACE = "insert_replace"
+S_LIMITS = "limits"
+S_LOGIN_SHELL_ENVIRONMENT = "login_shell_environment"
+S_LOGIN_SHELL_SNAPSHOT = "login_shell_snapshot"
+S_LOGIN_SHELL_TIMEOUT = "login_shell_timeout"
+S_NEW_VIEW = "new_view"
+S_NEW_VIEW_CHUNK_SIZE = "new_view_chunk_size"
+S_NEW_VIEW_SYNTAX = "new_view_syntax"
+S_NEW_VIEW_WORD_WRAP = "new_view_word_wrap"
 S_OUTPUT_PANEL = "output_panel"
 S_OUTPUT_PANEL_NAME = "output_panel_name"
 S_PANEL_SYNTAX = "panel_syntax"
 S_PANEL_FILE_REGEX = "panel_file_regex"
 S_PANEL_LINE_REGEX = "panel_line_regex"
 S_PANEL_WORD_WRAP = "panel_word_wrap"
+S_NEAREST = "nearest:"
 S_PHANTOM = "phantom"
+S_PHANTOM_LIMIT = "phantom_limit"
+S_PHANTOM_PREVIEW_SIZE = "phantom_preview_size"
+S_PROFILE_DIRECTORY = "profile_directory"
+S_PROFILE_TOP = "profile_top"
+S_PROGRESS_INTERVAL = "progress_interval"
+S_PROJECT = "project"
 S_RESET = "reset"
 S_SELECTED_TEXT = "selected_text"
 S_SINGLE_ARGUMENT = "single_argument"
+S_SINGLE_ARGUMENT_FALLBACK = "single_argument_fallback"
+S_SPECULATIVE_DELAY = "speculative_delay"
 S_TEMPORARY_FILE = "temporary_file"
 S_STDIN = "stdin"
 S_TEXT_URI = "text_uri"
 S_TIMEOUT_DELAY = "timeout_delay"
 
+# Resource limits
+# ----------------------------------------------------------------------------
+S_IONICE = "ionice"
+S_MAX_OUTPUT = "max_output"
+S_NICE = "nice"
+S_RLIMIT_AS = "rlimit_as"
+S_RLIMIT_CPU = "rlimit_cpu"
+S_RLIMIT_NOFILE = "rlimit_nofile"
+
+# I/O scheduling classes, after `ionice(1)`, with their default level.
+IOPRIO_CLASSES = {
+    "realtime": (1, 4),
+    "best_effort": (2, 4),
+    "idle": (3, 0),
+}
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_WHO_PROCESS = 1
+
+# There is no `ioprio_set` wrapper in the C library nor in Python.
+IOPRIO_SET_SYSCALLS = {
+    "x86_64": 251,
+    "i386": 289,
+    "i686": 289,
+    "aarch64": 30,
+    "armv7l": 314,
+}
+
+# Text programs typically write to `stderr` when a limit is hit.
+MEMORY_LIMIT_MESSAGES = [
+    "MemoryError",
+    "Cannot allocate memory",
+    "out of memory",
+    "std::bad_alloc",
+]
+OPEN_FILES_LIMIT_MESSAGES = [
+    "Too many open files",
+]
+
+# Limits added to those of speculative runs, see `Speculation`
+# ----------------------------------------------------------------------------
+SPECULATIVE_LIMITS = {
+    "nice": 19,
+    "ionice": "idle",
+}
+
+# Progress reported by programs on `stderr`, as `PROGRESS n/m` lines
+# ----------------------------------------------------------------------------
+PROGRESS_PATTERN = re.compile(br"^PROGRESS (\d+)/(\d+)\s*$")
+
 # Constants from settings
 # ----------------------------------------------------------------------------
 ERRORS_PANEL_NAME = None  # Initialized by `plugin_loaded`
 OUTPUT_PANEL_NAME = None  # Initialized by `plugin_loaded`
 
 
+# The job
+# ----------------------------------------------------------------------------
+class Job:
+
+    """ State of a program run on a view, until its result is written.
+
+    There is at most one job per view, see `ExternalProgramCommand.JOBS`.
+
+    When the destination is `insert_replace`, the target region is tracked
+    through the edits of the view, so that the result can still be applied
+    if the edits did not touch the target, see `track` and `get_target`.
+
+    """
+
+    TARGET_KEY = "external_programs.target.%i"  # Per job, see `finish`
+    COUNTER = itertools.count()
+
+    def __init__(self, view, destination, name):
+        """ Snapshot the state of `view` for a run of `name` to `destination`. """
+        self.view = view
+        self.destination = destination
+        self.name = name
+        self.started = time.time()
+        self.progress = None  # Last `(n, m)` reported by the program
+        self.process = None  # Set by `Pump`
+        self.stats = {}
+        self.aborted = False
+        self.change_count = view.change_count()
+        self.target = None
+        self.target_text = None
+        self.key = self.TARGET_KEY % next(self.COUNTER)
+
+    def track(self, region):
+        """ Start tracking `region` as the target of the result. """
+        view = self.view
+        self.target = region
+        self.target_text = view.substr(region)
+        view.add_regions(self.key, [region], "", "", sublime.HIDDEN)
+
+    def tracked_region(self):
+        """ Return the target region as moved by the edits, or `None`. """
+        regions = self.view.get_regions(self.key)
+        result = regions[0] if regions else None
+        return result
+
+    def target_overlapped(self):
+        """ Tell cheaply if an edit surely touched the target. """
+        region = self.tracked_region()
+        result = region is None or region.size() != len(self.target_text)
+        return result
+
+    def get_target(self):
+        """ Return the target region if unchanged, remapped, or else `None`.
+
+        If the view did not change at all, this is the original region.
+
+        """
+        if self.view.change_count() == self.change_count:
+            return self.target
+
+        result = None
+        region = self.tracked_region()
+        if region is not None and self.view.substr(region) == self.target_text:
+            result = region
+        return result
+
+    def finish(self):
+        """ Release what the job holds on the view.
+
+        This may be invoked more than once, and after another job on the
+        view started, as the region key is the job's own.
+
+        """
+        self.view.erase_regions(self.key)
+
+    def status(self):
+        """ Return the text to show in the status bar for the job.
+
+        The text changes at most once per second, unless the program reports
+        its progress.
+
+        """
+        elapsed = time.time() - self.started
+        if self.progress is None:
+            result = "%s [%is]" % (self.name, elapsed)
+        else:
+            (done, total) = self.progress
+            ratio = min(done / total, 1) if total else 0
+            size = 8
+            filled = int(ratio * size)
+            result = "%s [%s%s] %i%%" % (
+                self.name, "=" * filled, " " * (size - filled), ratio * 100)
+            if ratio:
+                result += " ETA %is" % (elapsed * (1 - ratio) / ratio)
+        return result
+
+
+# The pump
+# ----------------------------------------------------------------------------
+class Pump:
+
+    """ Move data between a program and the plug-in, through the pipes.
+
+    The input is written to the program while its output and errors are
+    read, from a single thread waiting on all the pipes with `select.poll`
+    (with a thread per pipe where there is no `poll`, that is, on Windows).
+    The output is decoded and passed through the filter by chunks, as it
+    comes, and the `PROGRESS n/m` error lines are reported to the job as
+    they come; these lines are not part of the errors returned. Invalid
+    UTF-8 is decoded as U+FFFD.
+
+    When `output_path` is given, the output is read from this file once the
+    program ended, by chunks too, while what the program writes to `stdout`
+    is left in `console`, as text.
+
+    Chunks are of `CHUNK_SIZE` bytes at most, and a chunk is read only once
+    the previous one was decoded and filtered. The output and errors are
+    still held in memory until the program ends, up to `budget` bytes: when
+    they exceed it, the program is killed and what was read within the
+    budget is kept, and the job stats tell it's `truncated`.
+
+    On time-out, the program is killed (see `ExternalProgramCommand.kill`)
+    and `subprocess.TimeoutExpired` is raised with what was read so far. On
+    any other error, the program is killed too, before the error is raised.
+
+    """
+
+    def __init__(self, process, job, input=None, input_stream=None, output_filter=None, budget=None, output_path=None):
+        """ Prepare to write `input` to `input_stream`, or else `stdin`. """
+        self.process = process
+        self.job = job
+        self.input = memoryview(input or b"")
+        self.input_stream = process.stdin if input_stream is None else input_stream
+        self.written = 0  # Bytes of `input`
+        self.output_filter = output_filter
+        self.budget = budget
+        self.output_path = output_path
+        self.size = 0  # Bytes read from the output and errors
+        self.truncated = False
+        self.decoders = {
+            "output": codecs.getincrementaldecoder("utf-8")("replace"),
+            "console": codecs.getincrementaldecoder("utf-8")("replace"),
+        }
+        self.stdout = []  # Text
+        self.console_chunks = []  # Text
+        self.console = ""  # See `output_path`
+        self.stderr = []  # Lines, as bytes
+        self.line = []  # Chunks of the incomplete line of errors
+        self.kinds = {  # Stream to what it carries
+            process.stdout: "output" if output_path is None else "console",
+            process.stderr: "errors",
+        }
+        self.close = None  # Set by `run_poll` or `run_threads`
+        self.abandoned = False
+        self.failure = None  # Exception raised in a thread
+        self.lock = threading.Lock()  # For the threads
+
+    def run(self, timeout):
+        """ Return `(stdout, stderr)` as text, like `process.communicate`. """
+        self.job.process = self.process
+        deadline = time.time() + timeout
+        try:
+            if hasattr(select, "poll"):
+                self.run_poll(deadline, timeout)
+            else:
+                self.run_threads(deadline, timeout)
+            if self.output_path is not None:
+                self.read_output_file()
+        except BaseException:
+            self.abandon()
+            raise
+        return self.result()
+
+    def run_poll(self, deadline, timeout):
+        """ Pump from the current thread, waiting with `select.poll`. """
+        poller = select.poll()
+        streams = {}  # File descriptor to stream
+
+        def close(stream):
+            """ Close `stream` and stop waiting for it. """
+            fd = stream.fileno()
+            poller.unregister(fd)
+            del streams[fd]
+            stream.close()
+
+        def close_all():
+            for stream in list(streams.values()):
+                close(stream)
+
+        self.close = close_all
+        for (stream, events) in [
+                (self.input_stream, select.POLLOUT),
+                (self.process.stdout, select.POLLIN),
+                (self.process.stderr, select.POLLIN)]:
+            if stream is not None:
+                streams[stream.fileno()] = stream
+                poller.register(stream, events)
+        if self.input_stream is not None and not self.input:
+            close(self.input_stream)
+
+        while streams:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                self.expire(timeout)
+            for (fd, event) in poller.poll(int(remaining * 1000) + 1):
+                stream = streams.get(fd)
+                if stream is None:
+                    continue
+                if stream is self.input_stream:
+                    # Beyond `PIPE_BUF`, a write may block.
+                    if event & select.POLLOUT and self.write(fd, select.PIPE_BUF):
+                        continue
+                    close(stream)
+                elif not self.consume(self.kinds[stream], os.read(fd, CHUNK_SIZE)):
+                    close(stream)
+            if self.truncated:
+                close_all()
+
+        try:
+            self.process.wait(max(deadline - time.time(), 0))
+        except subprocess.TimeoutExpired:
+            self.expire(timeout)
+
+    def run_threads(self, deadline, timeout):
+        """ Pump from a thread per pipe, with blocking reads and writes. """
+
+        def write(stream):
+            try:
+                while self.write(stream.fileno(), CHUNK_SIZE):
+                    pass
+            finally:
+                stream.close()
+
+        def read(stream):
+            try:
+                while self.consume(self.kinds[stream], os.read(stream.fileno(), CHUNK_SIZE)):
+                    pass
+            except BaseException as error:  # pylint: disable=broad-except
+                # Raised from `run`, once the program is killed.
+                self.failure = error
+                ExternalProgramCommand.kill(self.process)
+
+        threads = []
+        readers = []  # `(stream, thread)`
+        for (stream, method) in [
+                (self.input_stream, write),
+                (self.process.stdout, read),
+                (self.process.stderr, read)]:
+            if stream is not None:
+                thread = threading.Thread(target=method, args=(stream,))
+                thread.daemon = True
+                thread.start()
+                threads.append(thread)
+                if method is read:
+                    readers.append((stream, thread))
+
+        def close_all():
+            """ Close the pipes, as far as no thread uses them. """
+            # Processes which left the session may still hold the pipes open.
+            for thread in threads:
+                thread.join(1)
+            for (stream, thread) in readers:
+                if not thread.is_alive():
+                    stream.close()
+
+        self.close = close_all
+        try:
+            self.process.wait(max(deadline - time.time(), 0))
+        except subprocess.TimeoutExpired:
+            self.expire(timeout)
+
+        for thread in threads:
+            thread.join()
+        close_all()
+        if self.failure is not None:
+            raise self.failure
+
+    def read_output_file(self):
+        """ Read the output from `output_path`, through the budget. """
+        with open(self.output_path, "rb") as file:
+            while self.consume("output", file.read(CHUNK_SIZE)):
+                pass
+
+    def write(self, fd, size):
+        """ Write the next `size` bytes of input at most to `fd`.
+
+        Return `False` when there is nothing more to write, or the program
+        closed its end.
+
+        """
+        try:
+            self.written += os.write(fd, self.input[self.written:self.written + size])
+        except OSError:
+            return False
+        return self.written < len(self.input)
+
+    def consume(self, kind, chunk):
+        """ Handle `chunk` of `kind` (see `kinds`), which is empty at the end.
+
+        Return `False` when no more of `kind` is to be read.
+
+        """
+        with self.lock:
+            if self.truncated:
+                return False
+            end = not chunk
+            if self.budget is not None and self.size + len(chunk) > self.budget:
+                chunk = chunk[:max(self.budget - self.size, 0)]
+                self.truncated = True
+            self.size += len(chunk)
+
+            if kind == "output":
+                text = self.decoders[kind].decode(chunk, final=end)
+                if self.output_filter is not None:
+                    text = self.output_filter.feed(text)
+                self.stdout.append(text)
+            elif kind == "console":
+                self.console_chunks.append(self.decoders[kind].decode(chunk, final=end))
+            else:
+                # Joined only once complete, or long lines would be copied
+                # over and over.
+                lines = []
+                if b"\n" in chunk:
+                    lines = chunk.split(b"\n")
+                    self.line.append(lines[0])
+                    lines[0] = b"".join(self.line)
+                    self.line = [lines.pop()]
+                    lines = [line + b"\n" for line in lines]
+                else:
+                    self.line.append(chunk)
+                if end:
+                    line = b"".join(self.line)
+                    self.line = []
+                    if line:
+                        lines.append(line)
+                for line in lines:
+                    match = PROGRESS_PATTERN.match(line)
+                    if match is None:
+                        self.stderr.append(line)
+                    else:
+                        self.job.progress = (int(match.group(1)), int(match.group(2)))
+
+            if self.truncated:
+                self.job.stats["truncated"] = True
+                # The output file is read once the program ended.
+                if self.process.returncode is None:
+                    ExternalProgramCommand.kill(self.process)
+                return False
+            return not end
+
+    def result(self):
+        """ Return `(stdout, stderr)` as text, once and for all. """
+        if self.output_filter is not None:
+            self.stdout.append(self.output_filter.close())
+            self.output_filter = None
+        self.console = "".join(self.console_chunks)
+        return ("".join(self.stdout), b"".join(self.stderr).decode("utf-8", "replace"))
+
+    def expire(self, timeout):
+        """ Kill the program on time-out, and raise `TimeoutExpired`. """
+        self.abandon()
+        error = subprocess.TimeoutExpired(self.process.args, timeout)
+        with self.lock:
+            (error.output, error.stderr) = self.result()
+        raise error
+
+    def abandon(self):
+        """ Kill the program, wait for it and close the pipes, once. """
+        if self.abandoned:
+            return
+        self.abandoned = True
+        if self.process.returncode is None:
+            ExternalProgramCommand.kill(self.process)
+        self.process.wait()
+        if self.close is not None:
+            self.close()
+        else:
+            # Failed before pumping, so no thread uses them.
+            for stream in [self.input_stream, self.process.stdout, self.process.stderr]:
+                if stream is not None:
+                    stream.close()
+
+
+# The ticker
+# ----------------------------------------------------------------------------
+class Ticker:
+
+    """ Single timer showing the status of all the running jobs.
+
+    It runs while there are jobs, every `progress_interval` milliseconds, and
+    sets the status of a view only when its text changed.
+
+    """
+
+    RUNNING = False
+    SHOWN = {}  # View ID to `(view, text)`
+
+    KEY = "external_programs"
+
+    @classmethod
+    def start(cls):
+        """ Start ticking, if not already. """
+        if not cls.RUNNING:
+            cls.RUNNING = True
+            cls.tick()
+
+    @classmethod
+    def tick(cls):
+        """ Update the status of the views, then schedule the next tick. """
+        jobs = ExternalProgramCommand.JOBS
+        for (view_id, (view, _text)) in list(cls.SHOWN.items()):
+            if view_id not in jobs:
+                view.erase_status(cls.KEY)
+                del cls.SHOWN[view_id]
+
+        for (view_id, job) in list(jobs.items()):
+            text = job.status()
+            if cls.SHOWN.get(view_id, (None, None))[1] != text:
+                job.view.set_status(cls.KEY, text)
+                cls.SHOWN[view_id] = (job.view, text)
+
+        if jobs or cls.SHOWN:
+            interval = SETTINGS.get(S_PROGRESS_INTERVAL, DEFAULT_PROGRESS_INTERVAL)
+            sublime.set_timeout(cls.tick, interval)
+        else:
+            cls.RUNNING = False
+
+
 # The class
 # ----------------------------------------------------------------------------
 class ExternalProgramCommand(sublime_plugin.TextCommand):
@@ -122,10 +696,11 @@ class ExternalProgramCommand(sublime_plugin.TextCommand):
 
     """
 
-    BUSY = False
-    DESTINATION = None
+    JOBS = {}  # View ID to `Job`
+    DETACHED = []  # Processes not waited for, see `reap`
     ERRORS_PANEL = None
     OUTPUT_PANEL = None
+    NEW_VIEWS = {}  # Command name to `(view, generation)`
 
     def __init__(self, arg2):
         """ Just invoke the parent class constructor. """
@@ -363,7 +938,7 @@ class ExternalProgramCommand(sublime_plugin.TextCommand):
     # Output (how to write text returned by invoked program)
     # ------------------------------------------------------------------------
 
-    def get_insert_replace_writer(self, source):
+    def get_insert_replace_writer(self, source, job):
         """ Return a method to write to the current selection or `None`.
 
         If there is no selection or a multiple selection, additionally to
@@ -375,6 +950,10 @@ class ExternalProgramCommand(sublime_plugin.TextCommand):
         The selection may be empty, in which case it ends to be an “insert”,
         otherwise, it ends to be a “replace”.
 
+        The region is tracked by `job`: if the view was edited meanwhile, the
+        text is written to where the region moved, unless the region it-self
+        was edited, in which case the job is aborted.
+
         """
         result = None
         view = self.view
@@ -389,13 +968,25 @@ class ExternalProgramCommand(sublime_plugin.TextCommand):
             if region.empty() and source == S_SELECTED_TEXT:
                 region = sublime.Region(0, view.size())
 
-            def writer(text):
+            job.track(region)
+
+            def write_target(text):
+                """ Write `text` to the target region, from the UI thread. """
+                target = job.get_target()
+                job.finish()
+                if target is None:
+                    job.aborted = True
+                    sublime.status_message("Program aborted: target modified.")
+                    return
+
                 view.run_command("run_external_program", {
-                    "regions": [[region.begin(), region.end()]],
+                    "regions": [[target.begin(), target.end()]],
                     "results": [text],
                 })
 
-        return writer
+            result = lambda text: sublime.set_timeout(lambda: write_target(text), 0)
+
+        return result
 
     def get_output_panel_writer(self):
         """ Return a method to write to the output panel.
@@ -428,69 +1019,139 @@ class ExternalProgramCommand(sublime_plugin.TextCommand):
 
         The method returned expects a single `text` argument.
 
+        The phantom is added after the selection, by the `Phantoms` of the
+        view, see there.
+
         This is the method to be used when `destination` is `phantom`.
         """
+        view = self.view
+
+        def write_output(text):
+            """ Write `text` to a phantom, from the UI thread. """
+            region_end = view.sel()[0].end()
+
+            # Make sure that the phantom is always displayed at the bottom of a
+            # multi-line selection.
+            region = sublime.Region(region_end, region_end)
+
+            Phantoms.of_view(view).add(region, text)
+
+        result = lambda text: sublime.set_timeout(lambda: write_output(text), 0)
+        return result
+
+    def get_diagnostics_writer(self, directory):
+        """ Return a method to write to the diagnostics of the window.
+
+        The method returned expects a single `text` argument, which is parsed
+        into the window's `Diagnostics` index, using the
+        `diagnostics_file_regex` and `diagnostics_line_regex` settings or else
+        the `panel_file_regex` and `panel_line_regex` settings. Relative file
+        names are relative to `directory`, the working directory, and lines
+        without a file name refer to the last file name or else to the
+        active file.
+
+        This is the method to be used when `destination` is `diagnostics`.
+
+        If a regex is invalid, additionally to returning `None`, display an
+        error message in the status bar.
+
+        """
+        view = self.view
+        diagnostics = Diagnostics.of_window(view.window())
+        file_regex = (
+            SETTINGS.get(S_DIAGNOSTICS_FILE_REGEX)
+            or SETTINGS.get(S_PANEL_FILE_REGEX))
+        line_regex = (
+            SETTINGS.get(S_DIAGNOSTICS_LINE_REGEX)
+            or SETTINGS.get(S_PANEL_LINE_REGEX))
+
+        try:
+            Diagnostics.check(file_regex, line_regex)
+        except (ValueError, re.error) as error:
+            sublime.status_message("Error: invalid diagnostics regex: %s" % error)
+            return None
+
+        def write_diagnostics(text):
+            """ Index diagnostics from `text` and paint them. """
+            index = Diagnostics.parse(
+                text,
+                file_regex,
+                line_regex,
+                directory,
+                view.file_name())
+            sublime.set_timeout(lambda: diagnostics.update(index), 0)
+
+        result = write_diagnostics
+        return result
+
+    def get_new_view_writer(self, name, panels):
+        """ Return a method to write to a scratch view for the command `name`.
+
+        The method returned expects a single `text` argument.
+
+        The view is created on the first run and reused by the next runs of
+        the same command, as long as it's open. It's erased first, unless
+        `panels` is `accumulate`. The text is inserted by chunks of
+        `new_view_chunk_size` characters, one per `sublime.set_timeout` tick,
+        so that the editor stays responsive with large outputs, and the
+        `new_view_syntax` is assigned only after the last chunk.
+
+        This is the method to be used when `destination` is `new_view`.
+
+        """
+        cls = type(self)
+        window = self.view.window()
+        chunk_size = SETTINGS.get(S_NEW_VIEW_CHUNK_SIZE, DEFAULT_NEW_VIEW_CHUNK_SIZE)
+        syntax = SETTINGS.get(S_NEW_VIEW_SYNTAX, DEFAULT_NEW_VIEW_SYNTAX)
+
+        def get_view():
+            """ Return the view of the command and its new generation. """
+            (view, generation) = cls.NEW_VIEWS.get(name, (None, 0))
+            if view is None or view.window() is None:
+                view = window.new_file()
+                view.set_scratch(True)
+                view.set_name(name)
+                view.settings().set(
+                    "word_wrap",
+                    SETTINGS.get(S_NEW_VIEW_WORD_WRAP, False))
+            generation += 1
+            cls.NEW_VIEWS[name] = (view, generation)
+            return (view, generation)
 
         def write_output(text):
-            """ Write `text` to a phantom. """
-
-            style = '''
-                <style>
-                    html.dark {
-                        background-color: var(--yellowish);
-                    }
-                    html.light {
-                        background-color: #88db7d;
-                    }
-                    body {
-                        padding-right: 1rem;
-
-                        color: black;
-                    }
-                    .hide {
-                        color: black;
-
-                        text-decoration: none;
-                    }
-                </style>
-            '''
-
-            html_content = (
-                "<body id='external-programs'>"
-                    + style
-                    + "<a class='hide' href='hide'>&nbsp;" + chr(0x00D7) + "&nbsp;</a>&nbsp;"
-                    + "<span class='command-output'>"
-                        + html.escape(text.strip()).replace("\n", "<br>")
-                    + "</span>"
-                + "</body>"
-            )
-
-            phantom_id = str(random.randrange(1, 1000000))
-            region_end = self.view.sel()[0].end()
-
-            self.view.add_phantom(
-                # Sublime Text Phantom API doesn't provide a native mechanism to
-                # hide a single phantom. In order to emulate that feature, we use
-                # unique keys as "phantom set" key for each phantom and later use
-                # that key to hide a particular phantom.
-                "external_programs/" + phantom_id,
-
-                # Make sure that the phantom is always displayed at the bottom of a
-                # multi-line selection.
-                sublime.Region(region_end, region_end),
-
-                html_content,
-                sublime.LAYOUT_BLOCK,
-                on_navigate = self.get_phantom_navigate_method(phantom_id))
-
-        return write_output
-
-    def get_phantom_navigate_method(self, phantom_id):
-        def on_phantom_navigate(url):
-            if url == "hide":
-                self.view.erase_phantoms("external_programs/" + phantom_id)
-
-        return on_phantom_navigate
+            """ Start writing `text` to the view, from the UI thread. """
+            (view, generation) = get_view()
+            if panels != S_ACCUMULATE:
+                view.run_command("run_external_program", {
+                    "regions": [[0, view.size()]],
+                    "results": [""],
+                })
+
+            # Highlighting while inserting would be a waste.
+            view.assign_syntax(DEFAULT_NEW_VIEW_SYNTAX)
+            view.window().focus_view(view)
+
+            def write_chunk(offset):
+                """ Append a chunk, then schedule the next one. """
+                if cls.NEW_VIEWS.get(name) != (view, generation):
+                    return  # Closed or written by a newer run
+
+                chunk = text[offset:offset + chunk_size]
+                view.run_command("run_external_program", {
+                    "regions": [[view.size(), view.size()]],  # this means appending
+                    "results": [chunk],
+                })
+
+                offset += chunk_size
+                if offset < len(text):
+                    sublime.set_timeout(lambda: write_chunk(offset), 0)
+                else:
+                    view.assign_syntax(syntax)
+
+            write_chunk(0)
+
+        result = lambda text: sublime.set_timeout(lambda: write_output(text), 0)
+        return result
 
     @staticmethod
     def get_nothing_writer():
@@ -505,7 +1166,7 @@ class ExternalProgramCommand(sublime_plugin.TextCommand):
         result = lambda text: None
         return result
 
-    def get_output_method(self, source, destination):
+    def get_output_method(self, source, destination, name, panels, directory, job):
         """ Return the method to write the program result or `None`.
 
         If `destination` is unknown, additionally to returning `None`, display
@@ -513,16 +1174,23 @@ class ExternalProgramCommand(sublime_plugin.TextCommand):
 
         The method returned expects a single `text` argument.
 
+        `name` and `panels` are used when `destination` is `new_view`, `job`
+        when it is `insert_replace` and `directory` when it is `diagnostics`.
+
         This method handles the `destination` argument to `external_command`.
 
         """
         result = None
         if destination == S_INSERT_REPLACE:
-            result = self.get_insert_replace_writer(source)
+            result = self.get_insert_replace_writer(source, job)
         elif destination == S_OUTPUT_PANEL:
             result = self.get_output_panel_writer()
         elif destination == S_PHANTOM:
             result = self.get_phantom_writer()
+        elif destination == S_DIAGNOSTICS:
+            result = self.get_diagnostics_writer(directory)
+        elif destination == S_NEW_VIEW:
+            result = self.get_new_view_writer(name, panels)
         elif destination is None:
             result = self.get_nothing_writer()
         else:
@@ -542,31 +1210,328 @@ class ExternalProgramCommand(sublime_plugin.TextCommand):
         result = SETTINGS.get(S_TIMEOUT_DELAY, DEFAULT_TIMEOUT_DELAY)
         return result
 
-    def get_working_directory(self):
-        """ Return the directory of the active file or `None`.
+    @staticmethod
+    def get_single_argument_fallback():
+        """ Return the fallback channel after settings or else a default. """
+        result = SETTINGS.get(
+            S_SINGLE_ARGUMENT_FALLBACK,
+            DEFAULT_SINGLE_ARGUMENT_FALLBACK)
+        return result
+
+    @staticmethod
+    def get_limits(limits):
+        """ Return the resource limits after settings and `limits`.
+
+        The `limits` argument to `external_command` overrides the `limits`
+        setting, key by key.
+
+        """
+        result = dict(SETTINGS.get(S_LIMITS) or {})
+        result.update(limits or {})
+        return result
+
+    @staticmethod
+    def check_limits(limits):
+        """ Raise `ValueError` or `TypeError` if `limits` is invalid.
+
+        This is checked before anything is run, so that a mistake is told
+        in the status bar, rather than failing in `get_preexec_method` or
+        in the child process.
+
+        """
+        if limits is None:
+            return
+        if not isinstance(limits, dict):
+            raise TypeError("not an object: %r" % (limits,))
+
+        def is_integer(value):
+            return isinstance(value, int) and not isinstance(value, bool)
+
+        for (key, value) in limits.items():
+            if value is None:
+                continue
+            if key == S_IONICE:
+                name = value
+                if isinstance(value, list):
+                    if len(value) != 2 or not is_integer(value[1]) or not 0 <= value[1] <= 7:
+                        raise ValueError(
+                            "`ionice` is not a `[class, level]` pair, "
+                            "with a level from 0 to 7: %r" % (value,))
+                    name = value[0]
+                if not isinstance(name, str) or name not in IOPRIO_CLASSES:
+                    raise ValueError("unknown `ionice` class: %r" % (name,))
+            elif key == S_NICE:
+                if not is_integer(value):
+                    raise ValueError("`nice` is not an integer: %r" % (value,))
+            elif key in [S_RLIMIT_AS, S_RLIMIT_CPU, S_RLIMIT_NOFILE, S_MAX_OUTPUT]:
+                if not is_integer(value) or value < 0:
+                    raise ValueError("`%s` is not an integer of 0 or more: %r" % (key, value))
+            else:
+                raise ValueError("unknown limit: %r" % (key,))
+
+    @staticmethod
+    def get_preexec_method(limits):
+        """ Return a method applying `limits` in the child process or `None`.
+
+        `None` is returned when there is nothing to apply or on systems
+        without `resource` (Windows). The I/O priority is applied only on
+        Linux architectures listed in `IOPRIO_SET_SYSCALLS`.
+
+        The method returned expects no argument and is to be used as the
+        `preexec_fn` of `subprocess.Popen`, so everything it needs is
+        prepared here, before the fork. `limits` is expected to be valid,
+        see `check_limits`.
+
+        """
+        if not limits or resource is None:
+            return None
+
+        nice = limits.get(S_NICE)
+
+        ioprio = None
+        syscall = None
+        ionice = limits.get(S_IONICE)
+        number = IOPRIO_SET_SYSCALLS.get(platform.machine())
+        if ionice is not None and number is not None and sys.platform.startswith("linux"):
+            if isinstance(ionice, list):
+                (ioprio_class, level) = (IOPRIO_CLASSES[ionice[0]][0], ionice[1])
+            else:
+                (ioprio_class, level) = IOPRIO_CLASSES[ionice]
+            ioprio = (ioprio_class << IOPRIO_CLASS_SHIFT) | level
+            import ctypes
+            syscall = ctypes.CDLL(None, use_errno=True).syscall
+
+        rlimits = []
+        for (key, name, margin) in [
+                (S_RLIMIT_AS, resource.RLIMIT_AS, 0),
+                # One more second before `SIGKILL`, so `SIGXCPU` comes first.
+                (S_RLIMIT_CPU, resource.RLIMIT_CPU, 1),
+                (S_RLIMIT_NOFILE, resource.RLIMIT_NOFILE, 0)]:
+            value = limits.get(key)
+            if value is not None:
+                hard = resource.getrlimit(name)[1]
+                if hard != resource.RLIM_INFINITY:
+                    value = min(value, hard)
+                    margin = min(margin, hard - value)
+                rlimits.append((name, (value, value + margin)))
+
+        if not nice and ioprio is None and not rlimits:
+            return None
+
+        def preexec():
+            """ Apply the limits to the current (child) process. """
+            if nice:
+                os.nice(nice)
+            if ioprio is not None:
+                syscall(number, IOPRIO_WHO_PROCESS, 0, ioprio)
+            for (name, value) in rlimits:
+                resource.setrlimit(name, value)
+
+        return preexec
+
+    @staticmethod
+    def get_limit_violations(limits, return_code, stderr, truncated=False):
+        """ Return a list of messages for the `limits` the program hit.
+
+        The CPU time limit is told by the signal which killed the program
+        (from `RLIMIT_CPU`), while the others are guessed from the program's
+        `stderr`, as the program only gets errors from the system when it
+        hits them. The output limit is told by `truncated`, see `Pump`.
+
+        """
+        result = []
+        if truncated:
+            # Killed by `Pump`, not by the system.
+            result.append("Output limit of %s bytes exceeded, program killed." % (
+                (limits or {}).get(S_MAX_OUTPUT, DEFAULT_MAX_OUTPUT)))
+            return result
+        if return_code is None or not limits:
+            return result
+
+        # As the program runs through a shell, the signal may come as the
+        # status of the shell (128 + signal).
+        killers = [signal.SIGXCPU, signal.SIGKILL]
+        codes = [-killer for killer in killers] + [128 + killer for killer in killers]
+
+        cpu = limits.get(S_RLIMIT_CPU)
+        if cpu is not None and return_code in codes:
+            result.append("CPU time limit of %s s exceeded." % cpu)
+
+        memory = limits.get(S_RLIMIT_AS)
+        if (memory is not None
+                and return_code != 0
+                and any(text in stderr for text in MEMORY_LIMIT_MESSAGES)):
+            result.append("Memory limit of %s bytes exceeded." % memory)
+
+        files = limits.get(S_RLIMIT_NOFILE)
+        if (files is not None
+                and return_code != 0
+                and any(text in stderr for text in OPEN_FILES_LIMIT_MESSAGES)):
+            result.append("Open files limit of %s exceeded." % files)
+
+        return result
+
+    @staticmethod
+    def kill(process):
+        """ Kill `process` and the processes it started, as far as possible.
+
+        Programs are started in their own session, so that the processes
+        started by the shell, which may hold the pipes open, can be killed
+        with it.
+
+        """
+        try:
+            if hasattr(os, "killpg"):
+                os.killpg(process.pid, signal.SIGKILL)
+            else:
+                process.kill()
+        except OSError:
+            pass
+
+    @classmethod
+    def reap(cls):
+        """ Forget the detached processes which ended, so they are no zombies. """
+        cls.DETACHED = [process for process in cls.DETACHED if process.poll() is None]
+
+    @staticmethod
+    def remove_temporary_files():
+        """ Remove the temporary files left by a previous session.
+
+        This is to be invoked when no program can be running.
+
+        """
+        pattern = os.path.join(
+            sublime.packages_path(),
+            TEMPORARY_FILE_PREFIX + "*" + TEMPORARY_FILE_SUFFIX)
+        for path in glob.glob(pattern):
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+    @staticmethod
+    def get_argument_max():
+        """ Return the `exec` limit on arguments and environment, or `None`.
+
+        `None` means the limit is unknown, as on Windows.
+
+        """
+        result = None
+        try:
+            result = os.sysconf("SC_ARG_MAX")
+        except (AttributeError, ValueError, OSError):
+            pass
+        if result is not None and result <= 0:
+            result = None
+        return result
+
+    @staticmethod
+    def get_argument_size(arguments, environment):
+        """ Return `(total, longest)` sizes `exec` needs for the arguments.
+
+        `total` is the size of `arguments` and `environment`, encoded, with
+        each string counting its terminating NUL and its pointer in the
+        `argv` or `envp` array. `longest` is the size of the longest single
+        string, which Linux limits separately (`MAX_ARG_STRLEN`).
+
+        """
+        pointer_size = 8 if sys.maxsize > 2 ** 32 else 4
+        strings = [os.fsencode(argument) for argument in arguments]
+        strings.extend(
+            os.fsencode(key) + b"=" + os.fsencode(value)
+            for (key, value) in environment.items())
+        total = sum(len(string) + 1 + pointer_size for string in strings)
+        longest = max(len(string) + 1 for string in strings)
+        return (total, longest)
+
+    @classmethod
+    def exceeds_argument_max(cls, executable, environment):
+        """ Tell if `exec` would fail with `executable` as `shell=True` argv.
+
+        Returns `False` when the limit is unknown.
+
+        """
+        result = False
+        argument_max = cls.get_argument_max()
+        if argument_max is not None:
+            # What `subprocess.Popen` actually passes with `shell=True`.
+            arguments = ["/bin/sh", "-c"] + executable
+            (total, longest) = cls.get_argument_size(arguments, environment)
+            if sys.platform.startswith("linux"):
+                page_size = os.sysconf("SC_PAGE_SIZE")
+                result = longest > 32 * page_size
+            result = result or total > argument_max
+        return result
+
+    def get_working_directory(self, cwd=S_FILE_DIR):
+        """ Return the working directory after `cwd` or `None`.
 
         This is the directory to be used as the working directory of the
-        invoked program.
+        invoked program, which is either:
+
+         * `file_dir`: the directory of the active file;
+         * `project`: the directory of the project file;
+         * `folder`: the first folder of the window;
+         * `nearest:m1,m2,...`: the nearest directory containing one of the
+           marker files, from the active file upward, see `ProjectRoots`.
+
+        When there is no such directory, this is the directory of the
+        active file or `None` if there is no active file.
+
+        If `cwd` is unknown, additionally, display an error message in the
+        status bar.
+
+        This method handles the `cwd` argument to `external_command`.
 
         """
         result = None
         view = self.view
+        window = view.window()
         file = view.file_name()
+        file_directory = None
         if file is not None:
-            result = os.path.split(file)[0]
+            file_directory = os.path.split(file)[0]
+
+        if cwd == S_FILE_DIR:
+            pass
+        elif cwd == S_PROJECT:
+            project = window.project_file_name()
+            if project:
+                result = os.path.dirname(project)
+        elif cwd == S_FOLDER:
+            folders = window.folders()
+            if folders:
+                result = folders[0]
+        elif cwd.startswith(S_NEAREST):
+            markers = tuple(
+                marker.strip()
+                for marker in cwd[len(S_NEAREST):].split(",")
+                if marker.strip())
+            if file_directory is not None:
+                result = ProjectRoots.find(window, file_directory, markers)
+        else:
+            sublime.status_message("Error: unknown cwd `%s`" % cwd)
+
+        if result is None:
+            result = file_directory
         return result
 
     # ### Main
 
     @classmethod
-    def get_invokation_method(cls, executable, directory, through, output, destination):
+    def get_invokation_method(cls, executable, directory, through, output, destination, fallback, limits, filters, environment, job):
         """ Return the method to invoke the program or `None`.
 
         If `through` is unknown, additionally to returning `None`, display an
         error message in the status bar.
 
-        This method handles the `through` argument to `external_command` and
-        articulates the overall invocation process.
+        This method handles the `through` and `fallback` arguments to
+        `external_command` and articulates the overall invocation process.
+
+        The channel the text was actually passed through is recorded as
+        `channel` in the `job` stats. It differs from `through` when
+        a single argument would exceed the system limit on `exec` arguments,
+        in which case the `fallback` channel is used instead.
 
         The method depends on the way the parameter is passed to the program
         to be invoked.
@@ -584,9 +1549,48 @@ class ExternalProgramCommand(sublime_plugin.TextCommand):
         In case of error, the method returned, will write an error message to
         the status bar.
 
+        The program is started with the resource `limits` applied, see
+        `get_preexec_method`, its progress is reported to `job` and its output
+        is passed through `filters`, see `Pump` and `OutputFilter`.
+
+        The program's environment is `environment`, see `Environment.get`.
+
+        If `filters` or `limits` is invalid, additionally to returning `None`,
+        display an error message in the status bar.
+
         """
+        try:
+            OutputFilter.compile(filters)
+        except (ValueError, TypeError, re.error) as error:
+            sublime.status_message("Error: invalid filters: %s" % error)
+            return None
+
+        try:
+            cls.check_limits(limits)
+        except (ValueError, TypeError) as error:
+            sublime.status_message("Error: invalid limits: %s" % error)
+            return None
+
+        cls.reap()
 
         timeout_delay = cls.get_timeout_delay()
+        preexec = cls.get_preexec_method(limits)
+        max_output = (limits or {}).get(S_MAX_OUTPUT, DEFAULT_MAX_OUTPUT)
+        stats = job.stats
+
+        def get_output_filter():
+            """ Return a new `OutputFilter` after `filters` or `None`.
+
+            To be invoked before the program is started, so that a failure
+            leaves nothing running.
+
+            """
+            return OutputFilter(filters) if filters else None
+
+        def communicate(process, input=None, input_stream=None, output_filter=None):
+            """ Return `(stdout, stderr)` of `process`, see `Pump`. """
+            pump = Pump(process, job, input, input_stream, output_filter, max_output)
+            return pump.run(timeout_delay)
 
         # #### Exception handling
 
@@ -597,21 +1601,36 @@ class ExternalProgramCommand(sublime_plugin.TextCommand):
 
             Write an error message to the status bar, as much as possible.
 
+            Kill `process` if it was started and close its pipes, as `Pump`
+            does for its own errors, since the error may come from outside.
+
             """
             stderr = ""
             try:
                 raise error
-            except OSError:
-                message = "Error: Could not run command."
+            except OSError as os_error:
+                if os_error.errno == errno.E2BIG:
+                    message = "Error: Argument list too long."
+                else:
+                    message = "Error: Could not run command."
             except subprocess.TimeoutExpired as timeout:
-                stderr = getattr(timeout, "stderr", "")
-                process.kill()
-                (_stdout, stderr_tail) = process.communicate()
-                stderr += stderr_tail.decode("utf-8")
+                # Killed by `Pump`.
+                stderr = timeout.stderr or ""
                 message = "Error: Command takes too long."
+            except subprocess.SubprocessError:
+                # Other than time-out, only raised by `Popen` when `preexec` failed.
+                message = "Error: Could not apply resource limits."
             except Exception as err:  # pylint: disable=bare-except
                 message = "Error while attempting to run command: " + repr(err)
 
+            if process is not None:
+                if process.returncode is None:
+                    cls.kill(process)
+                process.wait()
+                for stream in [process.stdin, process.stdout, process.stderr]:
+                    if stream is not None:
+                        stream.close()
+
             print(message);
             sublime.status_message(message);
             return stderr
@@ -624,22 +1643,26 @@ class ExternalProgramCommand(sublime_plugin.TextCommand):
             Return `(stdout, stderr, return_code)`.
 
             """
+            process = None
             try:
+                output_filter = get_output_filter()
+
                 print("Executing: %s" % executable)
 
                 process = subprocess.Popen(
                     executable,
                     cwd=directory,
+                    env=environment,
                     shell=True,
                     stdin=subprocess.PIPE,
                     stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE)
-                (stdout, stderr) = process.communicate(
-                    input=text.encode("utf-8"),
-                    timeout=timeout_delay)
-
-                stdout = stdout.decode("utf-8")
-                stderr = stderr.decode("utf-8")
+                    stderr=subprocess.PIPE,
+                    preexec_fn=preexec,
+                    start_new_session=True)
+                (stdout, stderr) = communicate(
+                    process,
+                    text.encode("utf-8"),
+                    output_filter=output_filter)
 
                 result = (stdout, stderr, process.returncode)
             except Exception as error:  # pylint: disable=broad-except
@@ -649,31 +1672,52 @@ class ExternalProgramCommand(sublime_plugin.TextCommand):
         def invoke_using_single_argument(text):
             """ Invoke the program with `text` passed as a single argument.
 
+            If the argument is too long for the system, pass `text` through
+            the `fallback` channel instead.
+
             Return `(stdout, stderr, return_code)`.
 
             """
+            if cls.exceeds_argument_max(executable + [text], environment):
+                method = fallback_methods.get(fallback)
+                if method is None:
+                    message = "Error: argument too long and no usable fallback."
+                    print(message)
+                    sublime.status_message(message)
+                    return (None, "", None)
+
+                print("Argument too long, using fallback `%s`" % fallback)
+                stats["channel"] = fallback
+                return method(text)
+
+            process = None
             try:
                 executable.append(text)
 
+                output_filter = get_output_filter()
+
                 print("Executing: %s" % executable)
 
                 process = subprocess.Popen(
                     executable,
                     cwd=directory,
+                    env=environment,
                     shell=True,
                     stdin=None,
                     stdout = None if destination is None else subprocess.PIPE,
-                    stderr = None if destination is None else subprocess.PIPE)
+                    stderr = None if destination is None else subprocess.PIPE,
+                    preexec_fn=preexec,
+                    start_new_session=True)
 
                 if destination is not None:
-                    (stdout, stderr) = process.communicate(timeout=timeout_delay)
-                    stdout = stdout.decode("utf-8")
-                    stderr = stderr.decode("utf-8")
+                    (stdout, stderr) = communicate(
+                        process, output_filter=output_filter)
 
                     result = (stdout, stderr, process.returncode)
 
                 else:
                     # It's probably a GUI application. We're not interested in the output.
+                    cls.DETACHED.append(process)
                     result = ("", "", 0)
 
             except Exception as error:  # pylint: disable=broad-except
@@ -687,106 +1731,203 @@ class ExternalProgramCommand(sublime_plugin.TextCommand):
             Return `(output_text, stderr, return_code)`.
 
             """
+            process = None
+            file = None
             try:
-                with tempfile.NamedTemporaryFile(mode = "w+", dir = sublime.packages_path(), prefix = "external-programs-", suffix = ".temp", delete = False, encoding = "utf-8", newline = "") as file:
+                with tempfile.NamedTemporaryFile(mode = "w+", dir = sublime.packages_path(), prefix = TEMPORARY_FILE_PREFIX, suffix = TEMPORARY_FILE_SUFFIX, delete = False, encoding = "utf-8", newline = "") as file:
                     file.write(text)
                     file.close()
 
                     executable.append(file.name)
 
+                    output_filter = get_output_filter()
+
                     print("Executing: %s" % executable)
 
                     process = subprocess.Popen(
                         executable,
                         cwd = directory,
+                        env = environment,
                         shell = True,
                         stdin = None,
                         stdout = None if destination is None else subprocess.PIPE,
-                        stderr = None if destination is None else subprocess.PIPE)
+                        stderr = None if destination is None else subprocess.PIPE,
+                        preexec_fn = preexec,
+                        start_new_session = True)
 
                     if destination is not None:
-                        (stdout, stderr) = process.communicate(timeout = timeout_delay)
-                        stdout = stdout.decode("utf-8")
-                        stderr = stderr.decode("utf-8")
-
                         if output == "temporary_file":
-                            output_text = open(file.name, "r", encoding = "utf-8", newline = "").read()
+                            pump = Pump(
+                                process,
+                                job,
+                                output_filter = output_filter,
+                                budget = max_output,
+                                output_path = file.name)
+                            (output_text, stderr) = pump.run(timeout_delay)
 
-                            if stdout:
-                                print(stdout)
+                            if pump.console:
+                                print(pump.console)
 
                         else:
+                            (stdout, stderr) = communicate(
+                                process, output_filter=output_filter)
                             output_text = stdout
 
                         result = (output_text, stderr, process.returncode)
 
                     else:
                         # It's probably a GUI application. We're not interested in the output.
+                        cls.DETACHED.append(process)
                         result = ("", "", 0)
 
             except Exception as error:  # pylint: disable=broad-except
                 result = (None, on_error(error, process), None)
 
             finally:
-                if os.path.isfile(file.name):
+                if file is not None and os.path.isfile(file.name):
                     os.unlink(file.name)
 
             return result
 
-        def invoke_using_nothing(ignore):
-            """ Invoke the program with nothing (no argument, no input).
+        def invoke_using_dev_fd(text):
+            """ Invoke the program with a `/dev/fd` path to a pipe as a single
+            argument, `text` being written to the pipe.
 
             Return `(stdout, stderr, return_code)`.
 
             """
+            process = None
+            (read_fd, write_fd) = os.pipe()
             try:
+                executable.append("/dev/fd/%i" % read_fd)
+
+                output_filter = get_output_filter()
+
                 print("Executing: %s" % executable)
 
                 process = subprocess.Popen(
                     executable,
                     cwd=directory,
+                    env=environment,
                     shell=True,
                     stdin=None,
                     stdout = None if destination is None else subprocess.PIPE,
-                    stderr = None if destination is None else subprocess.PIPE)
+                    stderr = None if destination is None else subprocess.PIPE,
+                    pass_fds=(read_fd,),
+                    preexec_fn=preexec,
+                    start_new_session=True)
+
+                os.close(read_fd)
+                read_fd = None
+
+                pipe = open(write_fd, "wb")
+                write_fd = None
 
                 if destination is not None:
-                    (stdout, stderr) = process.communicate(timeout=timeout_delay)
-                    stdout = stdout.decode("utf-8")
-                    stderr = stderr.decode("utf-8")
+                    (stdout, stderr) = communicate(
+                        process,
+                        text.encode("utf-8"),
+                        pipe,
+                        output_filter)
 
                     result = (stdout, stderr, process.returncode)
 
                 else:
+                    def write_pipe():
+                        """ Write `text`, until the program closes it. """
+                        try:
+                            with pipe:
+                                pipe.write(text.encode("utf-8"))
+                        except OSError:
+                            pass
+
+                    writer = threading.Thread(target=write_pipe)
+                    writer.daemon = True
+                    writer.start()
+
                     # It's probably a GUI application. We're not interested in the output.
+                    cls.DETACHED.append(process)
                     result = ("", "", 0)
 
             except Exception as error:  # pylint: disable=broad-except
                 result = (None, on_error(error, process), None)
-            return result
 
-        # #### Main
+            finally:
+                for fd in (read_fd, write_fd):
+                    if fd is not None:
+                        os.close(fd)
 
-        if through == S_STDIN:
-            result = invoke_using_stdin
-        elif through == S_SINGLE_ARGUMENT:
-            result = invoke_using_single_argument
-        elif through == S_TEMPORARY_FILE:
-            result = invoke_using_temporary_file
-        elif through is None:
-            result = invoke_using_nothing
-        else:
-            result = None
-            sublime.status_message(
-                "Error: unknown channel `%s`"
-                % through)
+            return result
 
-        return result
+        def invoke_using_nothing(ignore):
+            """ Invoke the program with nothing (no argument, no input).
 
-    def selection_exists(self):
-        for region in self.view.sel():
-            if not region.empty():
-                return True
+            Return `(stdout, stderr, return_code)`.
+
+            """
+            process = None
+            try:
+                output_filter = get_output_filter()
+
+                print("Executing: %s" % executable)
+
+                process = subprocess.Popen(
+                    executable,
+                    cwd=directory,
+                    env=environment,
+                    shell=True,
+                    stdin=None,
+                    stdout = None if destination is None else subprocess.PIPE,
+                    stderr = None if destination is None else subprocess.PIPE,
+                    preexec_fn=preexec,
+                    start_new_session=True)
+
+                if destination is not None:
+                    (stdout, stderr) = communicate(
+                        process, output_filter=output_filter)
+
+                    result = (stdout, stderr, process.returncode)
+
+                else:
+                    # It's probably a GUI application. We're not interested in the output.
+                    cls.DETACHED.append(process)
+                    result = ("", "", 0)
+
+            except Exception as error:  # pylint: disable=broad-except
+                result = (None, on_error(error, process), None)
+            return result
+
+        # #### Main
+
+        fallback_methods = {
+            S_STDIN: invoke_using_stdin,
+            S_TEMPORARY_FILE: invoke_using_temporary_file,
+        }
+        if os.path.isdir("/dev/fd"):
+            fallback_methods[S_DEV_FD] = invoke_using_dev_fd
+
+        stats["channel"] = through
+
+        if through == S_STDIN:
+            result = invoke_using_stdin
+        elif through == S_SINGLE_ARGUMENT:
+            result = invoke_using_single_argument
+        elif through == S_TEMPORARY_FILE:
+            result = invoke_using_temporary_file
+        elif through is None:
+            result = invoke_using_nothing
+        else:
+            result = None
+            sublime.status_message(
+                "Error: unknown channel `%s`"
+                % through)
+
+        return result
+
+    def selection_exists(self):
+        for region in self.view.sel():
+            if not region.empty():
+                return True
 
         return False
 
@@ -800,7 +1941,13 @@ class ExternalProgramCommand(sublime_plugin.TextCommand):
             through = None,
             output = "stdout",
             destination = None,
-            panels=S_RESET):
+            panels=S_RESET,
+            fallback=None,
+            limits=None,
+            speculative=False,
+            filters=None,
+            env=None,
+            cwd=S_FILE_DIR):
 
         """ Invoke `executable` as specified by the next three parameters.
 
@@ -810,13 +1957,16 @@ class ExternalProgramCommand(sublime_plugin.TextCommand):
 
         """
         cls = type(self)
-        directory = self.get_working_directory()
+        directory = self.get_working_directory(cwd)
         # Parameters interpretation begin
         self.setup_panels(panels)
 
         if not type(executable) is list:
             executable = [executable]
 
+        # Before expansion, so it's the same for all files.
+        name = " ".join(executable)
+
         # Expand special variables. See: http://www.sublimetext.com/docs/3/build_systems.html#variables
         variables = self.view.window().extract_variables()
         executable = [sublime.expand_variables(value, variables) for value in executable]
@@ -827,35 +1977,95 @@ class ExternalProgramCommand(sublime_plugin.TextCommand):
         if destination is None:
             output = None
 
-        cls.DESTINATION = destination
+        if fallback is None:
+            fallback = self.get_single_argument_fallback()
+
+        limits = self.get_limits(limits)
+        environment = Environment.get(env, variables)
+
+        job = Job(self.view, destination, executable[0])
+        stats = job.stats
+
+        # Explicit runs go first.
+        Speculation.cancel()
 
         input = self.get_input(source)
-        invoke_method = self.get_invokation_method(executable, directory, through, output, destination)
-        output_method = self.get_output_method(source, destination)
+        invoke_method = self.get_invokation_method(
+            executable, directory, through, output, destination, fallback, limits, filters, environment, job)
+
+        if speculative and (source, destination) == (S_SELECTED_TEXT, S_INSERT_REPLACE):
+            Speculation.register(self.view, name, {
+                "executable": list(executable),
+                "directory": directory,
+                "through": through,
+                "output": output,
+                "fallback": fallback,
+                "limits": limits,
+                "filters": filters,
+                "environment": environment,
+            })
+            speculated = Speculation.take(self.view, name)
+            if speculated is not None:
+                stats["speculative"] = True
+                invoke_method = lambda text: speculated
+        elif speculative:
+            sublime.status_message(
+                "Error: `speculative` requires `selected_text` and `insert_replace`")
+        busy = self.view.id() in cls.JOBS
+        output_method = None
+        if not busy:
+            output_method = self.get_output_method(
+                source, destination, name, panels, directory, job)
+        selection_exists = self.selection_exists()
         # Parameters interpretation end
-        if cls.BUSY:
+        if busy:
             sublime.status_message("Error: busy")
         elif None not in [input, invoke_method, output_method]:
-            cls.BUSY = True
+            cls.JOBS[self.view.id()] = job
+            # Only now, so a run which does not start leaves it armed.
+            profiler = Profiler.take()
+            profiler.start("ui")
 
             # Core thread
             def thread():
+                profiler.start("worker")
+                try:
+                    work()
+                finally:
+                    # Even if writing the result failed, so the view is not busy
+                    # forever.
+                    if cls.JOBS.get(self.view.id()) is job:
+                        del cls.JOBS[self.view.id()]
+                    # When nothing was written, after what was written.
+                    sublime.set_timeout(job.finish, 0)
+                    profiler.stop("worker")
+                    # After what the writers scheduled on the UI thread.
+                    sublime.set_timeout(
+                        lambda: profiler.finish(name, self.get_output_panel_writer()), 0)
+
+            def work():
                 (result, stderr, return_code) = invoke_method(input)
 
-                # Check if the program is aborted.
-                if not cls.BUSY:
-                    return
-
                 # Sometimes commands may return an output with a trailing newline. If
                 # the input also has a trailing newline then we accept the one in the
                 # output, otherwise remove it.
-                if result is not None and not input.endswith("\n") and self.selection_exists():
+                if result is not None and not input.endswith("\n") and selection_exists:
                     result = result.rstrip("\n")
 
+                # Check if the program is aborted.
+                if job.aborted:
+                    # Even so, it may be recalled.
+                    if destination is not None:
+                        History.add(name, result, stderr, return_code, job)
+                    return
+
                 messages = []
 
                 if destination == "insert_replace":
-                    if result:
+                    if stats.get("truncated"):
+                        # Partial output, see the violation below.
+                        pass
+                    elif result:
                         output_method(result)
                     else:
                         messages.append("Empty output.")
@@ -865,6 +2075,11 @@ class ExternalProgramCommand(sublime_plugin.TextCommand):
                 if return_code is not None:
                     messages.append("Return code: %i" % return_code)
 
+                if stats["channel"] != through:
+                    messages.append("Passed through `%s`." % stats["channel"])
+
+                print("Job stats: %s" % stats)
+
                 if messages:
                     sublime.status_message(" ".join(messages));
 
@@ -873,27 +2088,24 @@ class ExternalProgramCommand(sublime_plugin.TextCommand):
                     self.write_error(stderr)
                     self.write_error("\n")
 
-                cls.BUSY = False
+                for violation in self.get_limit_violations(
+                        limits, return_code, stderr, stats.get("truncated", False)):
+                    message = "Error: %s" % violation
+                    print(message)
+                    sublime.status_message(message)
+                    self.write_error("%s\n" % message)
 
-            _thread.start_new_thread(thread, ())
+                # Last, as it may write older results to disk.
+                if destination is not None:
+                    History.add(name, result, stderr, return_code, job)
 
-            # Source: https://github.com/greneholt/SublimeExternalCommand
-            def spin(size, i=0, addend=1):
-                if not cls.BUSY:
-                    self.view.erase_status("external_programs")
-                    return
+            _thread.start_new_thread(thread, ())
 
-                before = i % size
-                after = (size - 1) - before
-                self.view.set_status("external_programs", "%s [%s=%s]" % (executable[0], " " * before, " " * after))
-                if not after:
-                    addend = -1
-                if not before:
-                    addend = 1
-                i += addend
-                sublime.set_timeout(lambda: spin(size, i, addend), 100)
+            Ticker.start()
 
-            spin(8)
+        else:
+            job.finish()
+            profiler.finish(name, self.get_output_panel_writer())
 
     @staticmethod
     def description():
@@ -919,24 +2131,42 @@ class RunExternalProgramCommand(sublime_plugin.TextCommand):
         return False
 
 class ExternalProgramListener(sublime_plugin.EventListener):
-    def abort_program(self):
-        if ExternalProgramCommand.BUSY:
-            ExternalProgramCommand.BUSY = False
+    def abort_program(self, view_id):
+        job = ExternalProgramCommand.JOBS.pop(view_id, None)
+        if job is not None:
+            job.aborted = True
+            job.finish()
             sublime.status_message("Program aborted.");
 
     def on_modified(self, view):
-        if ExternalProgramCommand.DESTINATION == "insert_replace":
-            self.abort_program()
+        # Only edits to the target of the job on this very view matter, the
+        # others are accounted for when the result is written.
+        job = ExternalProgramCommand.JOBS.get(view.id())
+        if (job is not None
+                and job.destination == S_INSERT_REPLACE
+                and job.target_overlapped()):
+            self.abort_program(view.id())
 
-    def on_selection_modified(self, view):
-        if ExternalProgramCommand.DESTINATION == "insert_replace":
-            self.abort_program()
+        Speculation.on_modified(view)
 
     def on_close(self, view):
-        self.abort_program()
+        self.abort_program(view.id())
+        Phantoms.INSTANCES.pop(view.id(), None)
+        Speculation.forget(view)
+
+    def on_post_window_command(self, window, command_name, args):
+        # Folders may have been added or removed, or their content changed.
+        if command_name in ["refresh_folder_list", "prompt_add_folder", "remove_folder"]:
+            ProjectRoots.forget(window)
+
+    def on_load(self, view):
+        window = view.window()
+        if window is not None and window.id() in Diagnostics.INSTANCES:
+            Diagnostics.INSTANCES[window.id()].paint(view)
 
     def __del__(self):
-        self.abort_program()
+        for view_id in list(ExternalProgramCommand.JOBS):
+            self.abort_program(view_id)
 
 # Helper commands
 # ----------------------------------------------------------------------------
@@ -981,6 +2211,1267 @@ class ExternalProgramShowOutput(sublime_plugin.WindowCommand):
             sublime.status_message("No output result so far.")
 
 
+# Diagnostics
+# ============================================================================
+
+class Diagnostics:
+
+    """ Index of the diagnostics parsed from programs output, per window.
+
+    The index maps normalized absolute file names to maps from line numbers
+    to lists of `(column, message)`. Line and column numbers are 1-based,
+    the column may be `None`.
+
+    Diagnostics are painted as regions in the views of the indexed files,
+    and only the views of the files whose diagnostics changed are painted
+    again on update.
+
+    """
+
+    INSTANCES = {}  # Window ID to `Diagnostics`
+    PATTERNS = {}  # Regular expression to compiled pattern
+
+    REGIONS_KEY = "external_programs.diagnostics"
+
+    def __init__(self, window):
+        """ Create an empty index for `window`. """
+        self.window = window
+        self.index = {}
+        self.positions = []  # Sorted `(file, line, column, message)`
+        self.current = -1
+
+    @classmethod
+    def of_window(cls, window):
+        """ Return the single instance for `window`, created on demand. """
+        result = cls.INSTANCES.get(window.id())
+        if result is None:
+            result = cls(window)
+            cls.INSTANCES[window.id()] = result
+        return result
+
+    @classmethod
+    def compile(cls, regex):
+        """ Return the compiled pattern of `regex` or `None` if none. """
+        result = None
+        if regex:
+            result = cls.PATTERNS.get(regex)
+            if result is None:
+                result = re.compile(regex)
+                cls.PATTERNS[regex] = result
+        return result
+
+    @classmethod
+    def check(cls, file_regex, line_regex):
+        """ Raise `ValueError` or `re.error` if a regex can't be parsed with.
+
+        `file_regex` needs at least the file name and line groups, and
+        `line_regex` the line group, see `parse`.
+
+        """
+        for (regex, groups, names) in [
+                (file_regex, 2, "file name and line"),
+                (line_regex, 1, "line")]:
+            pattern = cls.compile(regex)
+            if pattern is not None and pattern.groups < groups:
+                raise ValueError("%r has no %s groups" % (regex, names))
+
+    @staticmethod
+    def normalize(file):
+        """ Return `file` as an index key. """
+        return os.path.normcase(os.path.abspath(file))
+
+    @classmethod
+    def parse(cls, text, file_regex, line_regex, directory, default_file):
+        """ Return an index of the diagnostics in `text`, in one pass.
+
+        `file_regex` is to capture file name, line, column and message,
+        `line_regex` line, column and message, after the Sublime Text
+        `result_file_regex` and `result_line_regex` settings (see `check`).
+        When there is no message group, the message is the whole line.
+
+        """
+        file_pattern = cls.compile(file_regex)
+        line_pattern = cls.compile(line_regex)
+        last_file = default_file
+
+        result = {}
+        for text_line in text.splitlines():
+            match = file_pattern.search(text_line) if file_pattern else None
+            if match is not None:
+                groups = match.groups()
+                file = groups[0]
+                groups = groups[1:]
+                if file:
+                    if directory is not None:
+                        file = os.path.join(directory, file)
+                    last_file = file
+            else:
+                match = line_pattern.search(text_line) if line_pattern else None
+                if match is None:
+                    continue
+                groups = match.groups()
+                file = last_file
+
+            (line, column, message) = (tuple(groups) + (None,) * 3)[:3]
+            if not file or not line:
+                continue
+
+            entries = result.setdefault(cls.normalize(file), {})
+            entries.setdefault(int(line), []).append((
+                int(column) if column else None,
+                (message or text_line).strip()))
+
+        return result
+
+    def update(self, index):
+        """ Replace the index with `index` and paint what changed. """
+        files = set(self.index) | set(index)
+        changed = set(
+            file for file in files
+            if self.index.get(file) != index.get(file))
+
+        self.index = index
+        self.positions = sorted(
+            (file, line, column or 1, message)
+            for (file, lines) in index.items()
+            for (line, entries) in lines.items()
+            for (column, message) in entries)
+        self.current = -1
+
+        for view in self.window.views():
+            file = view.file_name()
+            if file is not None and self.normalize(file) in changed:
+                self.paint(view)
+
+        sublime.status_message(
+            "%i diagnostic(s) in %i file(s)."
+            % (len(self.positions), len(index)))
+
+    def paint(self, view):
+        """ Paint the diagnostics of the file of `view`, if any. """
+        file = view.file_name()
+        lines = self.index.get(self.normalize(file)) if file else None
+        if not lines:
+            view.erase_regions(self.REGIONS_KEY)
+            return
+
+        regions = []
+        for (line, entries) in lines.items():
+            line_region = view.line(view.text_point(line - 1, 0))
+            for (column, _message) in entries:
+                begin = line_region.begin()
+                if column is not None:
+                    begin = min(begin + column - 1, line_region.end())
+                regions.append(sublime.Region(begin, line_region.end()))
+
+        view.add_regions(
+            self.REGIONS_KEY,
+            regions,
+            SETTINGS.get(S_DIAGNOSTICS_SCOPE, DEFAULT_DIAGNOSTICS_SCOPE),
+            SETTINGS.get(S_DIAGNOSTICS_ICON, DEFAULT_DIAGNOSTICS_ICON),
+            sublime.DRAW_SQUIGGLY_UNDERLINE
+            | sublime.DRAW_NO_FILL
+            | sublime.DRAW_NO_OUTLINE)
+
+    def navigate(self, step):
+        """ Open the diagnostic `step` positions away from the current one. """
+        if not self.positions:
+            sublime.status_message("No diagnostics.")
+            return
+
+        self.current = (self.current + step) % len(self.positions)
+        (file, line, column, message) = self.positions[self.current]
+        self.window.open_file(
+            "%s:%i:%i" % (file, line, column),
+            sublime.ENCODED_POSITION)
+        sublime.status_message(
+            "Diagnostic %i/%i: %s"
+            % (self.current + 1, len(self.positions), message))
+
+
+# ### `external_program_next_diagnostic`
+
+class ExternalProgramNextDiagnostic(sublime_plugin.WindowCommand):
+
+    """ Command to go to the next diagnostic. """
+
+    def run(self):
+        """ Go to the next diagnostic. """
+        Diagnostics.of_window(self.window).navigate(1)
+
+
+# ### `external_program_previous_diagnostic`
+
+class ExternalProgramPreviousDiagnostic(sublime_plugin.WindowCommand):
+
+    """ Command to go to the previous diagnostic. """
+
+    def run(self):
+        """ Go to the previous diagnostic. """
+        Diagnostics.of_window(self.window).navigate(-1)
+
+
+# Project roots
+# ============================================================================
+
+class ProjectRoots:
+
+    """ Cache of the nearest directories containing marker files.
+
+    For each directory and markers, the nearest directory upward containing
+    one of the markers (or `None`) is cached, for all the directories
+    walked through, so that it's looked up on the file system only once.
+
+    The cache of a window is cleared when its folders change.
+
+    """
+
+    ROOTS = {}  # Window ID to `{(directory, markers): root}`
+    FOLDERS = {}  # Window ID to the folders the roots were cached with
+
+    @classmethod
+    def find(cls, window, directory, markers):
+        """ Return the nearest directory from `directory` up with `markers`.
+
+        Return `None` if there is none.
+
+        """
+        folders = tuple(window.folders())
+        if cls.FOLDERS.get(window.id()) != folders:
+            cls.FOLDERS[window.id()] = folders
+            cls.ROOTS[window.id()] = {}
+        roots = cls.ROOTS[window.id()]
+
+        key = (directory, markers)
+        if key in roots:
+            return roots[key]
+
+        walked = []
+        result = None
+        while True:
+            key = (directory, markers)
+            if key in roots:
+                result = roots[key]
+                break
+            walked.append(key)
+            if any(os.path.exists(os.path.join(directory, marker)) for marker in markers):
+                result = directory
+                break
+            parent = os.path.dirname(directory)
+            if parent == directory:
+                break
+            directory = parent
+
+        for key in walked:
+            roots[key] = result
+        return result
+
+    @classmethod
+    def forget(cls, window):
+        """ Clear the cache of `window`. """
+        cls.ROOTS.pop(window.id(), None)
+        cls.FOLDERS.pop(window.id(), None)
+
+
+# Environment
+# ============================================================================
+
+class Environment:
+
+    """ The environment of the user's login shell, for the programs.
+
+    When Sublime Text is launched from a desktop launcher, it does not get the
+    environment set by the login shell (like `PATH`), and neither do the
+    programs it starts. The environment of the login shell is captured once,
+    in the background, when the plug-in is loaded and on
+    `external_program_refresh_environment`. It may be saved to disk, so that
+    it's available at once on the next load.
+
+    This is after the `login_shell_environment` and `login_shell_snapshot`
+    settings, and only on systems other than Windows.
+
+    """
+
+    SNAPSHOT = None  # Captured environment, or `None`
+    MARKER = "EXTERNAL_PROGRAMS_ENVIRONMENT"
+
+    @staticmethod
+    def snapshot_file():
+        """ Return the path of the on-disk snapshot. """
+        return os.path.join(
+            sublime.cache_path(),
+            "External_Programs",
+            "environment.json")
+
+    @staticmethod
+    def enabled():
+        """ Tell if the login shell environment is to be used. """
+        return (
+            sublime.platform() != "windows"
+            and SETTINGS.get(S_LOGIN_SHELL_ENVIRONMENT, DEFAULT_LOGIN_SHELL_ENVIRONMENT))
+
+    @classmethod
+    def capture(cls):
+        """ Return the environment of the login shell or `None` on error. """
+        shell = os.environ.get("SHELL", "/bin/sh")
+        timeout = SETTINGS.get(S_LOGIN_SHELL_TIMEOUT, DEFAULT_LOGIN_SHELL_TIMEOUT)
+        # What the shell start-up files print, comes before the marker.
+        # `env -0` is not on every system, then values can't have newlines.
+        command = "printf '%%s\\0' %s; env -0 2>/dev/null || env" % cls.MARKER
+        result = None
+        try:
+            output = subprocess.check_output(
+                [shell, "-l", "-c", command],
+                stdin=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                timeout=timeout)
+        except (OSError, subprocess.SubprocessError) as error:
+            print("Could not capture login shell environment: %r" % error)
+        else:
+            text = output.decode("utf-8", "replace")
+            marker = cls.MARKER + "\0"
+            if marker in text:
+                text = text.split(marker, 1)[1]
+                entries = text.split("\0" if "\0" in text else "\n")
+                result = dict(
+                    entry.split("=", 1) for entry in entries if "=" in entry)
+        return result
+
+    @classmethod
+    def load(cls):
+        """ Load the on-disk snapshot, if any and enabled. """
+        if not cls.enabled() or not SETTINGS.get(S_LOGIN_SHELL_SNAPSHOT, DEFAULT_LOGIN_SHELL_SNAPSHOT):
+            return
+        try:
+            with open(cls.snapshot_file(), encoding="utf-8") as file:
+                cls.SNAPSHOT = json.load(file)
+        except (OSError, ValueError):
+            pass
+
+    @classmethod
+    def refresh(cls):
+        """ Capture the environment again, in the background. """
+        if not cls.enabled():
+            cls.SNAPSHOT = None
+            return
+
+        def thread():
+            snapshot = cls.capture()
+            if snapshot is None:
+                return
+            cls.SNAPSHOT = snapshot
+            sublime.status_message("Login shell environment captured.")
+            if SETTINGS.get(S_LOGIN_SHELL_SNAPSHOT, DEFAULT_LOGIN_SHELL_SNAPSHOT):
+                path = cls.snapshot_file()
+                try:
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    with open(path, "w", encoding="utf-8") as file:
+                        json.dump(snapshot, file)
+                except OSError as error:
+                    print("Could not save login shell environment: %r" % error)
+
+        _thread.start_new_thread(thread, ())
+
+    @classmethod
+    def get(cls, env, variables):
+        """ Return the environment for a program, with the `env` overrides.
+
+        `env` values may refer to window variables and to the environment,
+        like `"${PATH}:/opt/bin"`; `null` values remove the variable.
+
+        """
+        result = dict(os.environ)
+        if cls.SNAPSHOT is not None and cls.enabled():
+            result.update(cls.SNAPSHOT)
+        if env:
+            expansion = dict(result)
+            expansion.update(variables)
+            for (key, value) in env.items():
+                if value is None:
+                    result.pop(key, None)
+                else:
+                    result[key] = sublime.expand_variables(value, expansion)
+        return result
+
+
+# ### `external_program_refresh_environment`
+
+class ExternalProgramRefreshEnvironment(sublime_plugin.ApplicationCommand):
+
+    """ Command to capture the login shell environment again. """
+
+    def run(self):
+        """ Capture the login shell environment again. """
+        Environment.refresh()
+
+
+# Filters
+# ============================================================================
+
+class OutputFilter:
+
+    """ Streaming filter of a program's output, after `filters`.
+
+    `filters` is a list of stages, each an object with a single key:
+
+     * `include`: regular expression, keep only the lines matching it;
+     * `exclude`: regular expression, drop the lines matching it;
+     * `substitute`: `[regex, replacement]`, as `re.sub` on each line;
+     * `head`: number, keep only the first lines;
+     * `tail`: number, keep only the last lines;
+     * `dedupe`: `true`, drop lines already seen;
+     * `trim`: `true`, drop trailing spaces of lines and leading and trailing
+       blank lines.
+
+    A `false` `dedupe` or `trim` stage does nothing.
+
+    Stages apply in order, line by line, as text is fed, except `tail`,
+    which holds its lines until the end. Whether the output ends with a
+    newline is kept as is.
+
+    Compiled stages are cached, so that each specification is compiled
+    once.
+
+    """
+
+    COMPILED = {}  # JSON of `filters` to compiled stages
+
+    KINDS = ["include", "exclude", "substitute", "head", "tail", "dedupe", "trim"]
+
+    def __init__(self, filters):
+        """ Start filtering with fresh state, after `filters`. """
+        self.stages = self.compile(filters)
+        self.states = [self.initial_state(kind, argument) for (kind, argument) in self.stages]
+        self.partial = []  # Chunks of the last line, not terminated yet
+        self.emitted = False
+        self.newline = False
+
+    @classmethod
+    def compile(cls, filters):
+        """ Return the stages of `filters` as `(kind, argument)` pairs.
+
+        Raise `ValueError` or `re.error` if `filters` is invalid.
+
+        """
+        def is_integer(value):
+            return isinstance(value, int) and not isinstance(value, bool)
+
+        key = json.dumps(filters, sort_keys=True)
+        result = cls.COMPILED.get(key)
+        if result is None:
+            result = []
+            for stage in filters or []:
+                if not isinstance(stage, dict) or len(stage) != 1:
+                    raise ValueError("a stage must be an object with one key")
+                ((kind, argument),) = stage.items()
+                if kind not in cls.KINDS:
+                    raise ValueError("unknown stage `%s`" % kind)
+                if kind in ["include", "exclude"]:
+                    argument = re.compile(argument)
+                elif kind == "substitute":
+                    (pattern, replacement) = argument
+                    argument = (re.compile(pattern), replacement)
+                elif kind in ["head", "tail"]:
+                    if not is_integer(argument) or argument < 0:
+                        raise ValueError(
+                            "`%s` is not an integer of 0 or more: %r" % (kind, argument))
+                elif not isinstance(argument, bool):
+                    raise ValueError("`%s` is not a boolean: %r" % (kind, argument))
+                elif not argument:
+                    continue
+                result.append((kind, argument))
+            cls.COMPILED[key] = result
+        return result
+
+    @staticmethod
+    def initial_state(kind, argument):
+        """ Return the state of a stage, before any line. """
+        result = None
+        if kind == "head":
+            result = [0]  # Lines passed
+        elif kind == "tail":
+            result = collections.deque(maxlen=argument)
+        elif kind == "dedupe":
+            result = set()
+        elif kind == "trim":
+            result = [False, 0]  # Non-blank line seen, blank lines held
+        return result
+
+    def push(self, lines, start=0):
+        """ Return `lines` as passed through the stages from `start`. """
+        for index in range(start, len(self.stages)):
+            if not lines:
+                break
+            (kind, argument) = self.stages[index]
+            state = self.states[index]
+            if kind == "include":
+                lines = [line for line in lines if argument.search(line)]
+            elif kind == "exclude":
+                lines = [line for line in lines if not argument.search(line)]
+            elif kind == "substitute":
+                (pattern, replacement) = argument
+                lines = [pattern.sub(replacement, line) for line in lines]
+            elif kind == "head":
+                lines = lines[:max(argument - state[0], 0)]
+                state[0] += len(lines)
+            elif kind == "tail":
+                state.extend(lines)
+                lines = []
+            elif kind == "dedupe":
+                kept = []
+                for line in lines:
+                    if line not in state:
+                        state.add(line)
+                        kept.append(line)
+                lines = kept
+            elif kind == "trim":
+                kept = []
+                for line in lines:
+                    line = line.rstrip()
+                    if not line:
+                        state[1] += state[0]
+                    else:
+                        kept.extend([""] * state[1])
+                        kept.append(line)
+                        state[0] = True
+                        state[1] = 0
+                lines = kept
+        return lines
+
+    def join(self, lines):
+        """ Return `lines` as text following what was already emitted. """
+        result = ""
+        if lines:
+            result = ("\n" if self.emitted else "") + "\n".join(lines)
+            self.emitted = True
+        return result
+
+    def feed(self, text):
+        """ Filter the complete lines of `text` and return the result. """
+        if not text:
+            return ""
+        self.newline = text.endswith("\n")
+        # Joined only once complete, or long lines would be copied over and
+        # over.
+        if "\n" not in text:
+            self.partial.append(text)
+            return ""
+        lines = text.split("\n")
+        self.partial.append(lines[0])
+        lines[0] = "".join(self.partial)
+        self.partial = [lines.pop()]
+        result = self.join(self.push(lines))
+        return result
+
+    def close(self):
+        """ Filter what is left and return the result. """
+        result = ""
+        partial = "".join(self.partial)
+        self.partial = []
+        if partial:
+            result += self.join(self.push([partial]))
+        for (index, (kind, _argument)) in enumerate(self.stages):
+            if kind == "tail":
+                result += self.join(self.push(list(self.states[index]), index + 1))
+        if self.newline and self.emitted:
+            result += "\n"
+        return result
+
+
+# Speculation
+# ============================================================================
+
+class Speculation:
+
+    """ Speculative runs of formatters, while views are idle.
+
+    Commands run with `speculative` are registered for their view. When the
+    view has not been modified for `speculative_delay` milliseconds, the
+    registered commands are run on the selection in the background, one at a
+    time, with the lowest priority (`SPECULATIVE_LIMITS`). Results are kept
+    along with the change count of the view and the selection, so that the
+    next explicit run of the command on the same text and selection, writes
+    the result without waiting for the program.
+
+    A speculative run is cancelled (its program is killed) by the next
+    modification of its view and by any explicit run.
+
+    """
+
+    PROFILES = {}  # View ID to `{name: parameters}`
+    RESULTS = {}  # View ID to `{name: (change_count, target, result)}`
+    JOB = None  # The running speculative `Job`
+    QUEUE = []  # `(view, name)` waiting for the lane
+
+    @staticmethod
+    def target(view):
+        """ Return the selected region as `(begin, end)`, or `None`.
+
+        As with `selected_text`, no selection means the whole buffer.
+
+        """
+        result = None
+        sel = view.sel()
+        if len(sel) == 1:
+            region = sel[0]
+            if region.empty():
+                region = sublime.Region(0, view.size())
+            result = (region.begin(), region.end())
+        return result
+
+    @classmethod
+    def register(cls, view, name, parameters):
+        """ Register command `name` for speculative runs on `view`. """
+        cls.PROFILES.setdefault(view.id(), {})[name] = parameters
+
+    @classmethod
+    def take(cls, view, name):
+        """ Return and forget the speculated `(stdout, stderr, return_code)`.
+
+        Return `None` if there is none for the current text and selection.
+
+        """
+        result = None
+        entry = cls.RESULTS.get(view.id(), {}).pop(name, None)
+        if entry is not None:
+            (change_count, target, speculated) = entry
+            if change_count == view.change_count() and target == cls.target(view):
+                result = speculated
+        return result
+
+    @classmethod
+    def cancel(cls, view=None):
+        """ Cancel the speculative runs, of `view` only, if given. """
+        cls.QUEUE = [
+            (queued_view, name) for (queued_view, name) in cls.QUEUE
+            if view is not None and queued_view.id() != view.id()]
+
+        job = cls.JOB
+        if job is not None and (view is None or job.view.id() == view.id()):
+            job.aborted = True
+            process = job.process
+            if process is not None and process.poll() is None:
+                ExternalProgramCommand.kill(process)
+
+    @classmethod
+    def forget(cls, view):
+        """ Forget everything about `view`. """
+        cls.cancel(view)
+        cls.PROFILES.pop(view.id(), None)
+        cls.RESULTS.pop(view.id(), None)
+
+    @classmethod
+    def on_modified(cls, view):
+        """ Cancel what is stale and wait for `view` to be idle. """
+        if view.id() not in cls.PROFILES:
+            return
+
+        cls.cancel(view)
+        cls.RESULTS.pop(view.id(), None)
+        change_count = view.change_count()
+        delay = SETTINGS.get(S_SPECULATIVE_DELAY, DEFAULT_SPECULATIVE_DELAY)
+        sublime.set_timeout(lambda: cls.on_idle(view, change_count), delay)
+
+    @classmethod
+    def on_idle(cls, view, change_count):
+        """ Queue the commands of `view`, if not modified since `change_count`. """
+        if (view.change_count() == change_count
+                and view.id() in cls.PROFILES
+                and view.id() not in ExternalProgramCommand.JOBS):
+            for name in cls.PROFILES[view.id()]:
+                cls.QUEUE.append((view, name))
+            cls.next()
+
+    @classmethod
+    def next(cls):
+        """ Start the next queued speculative run, if the lane is free. """
+        while cls.JOB is None and cls.QUEUE:
+            (view, name) = cls.QUEUE.pop(0)
+            parameters = cls.PROFILES.get(view.id(), {}).get(name)
+            target = cls.target(view)
+            if parameters is not None and target is not None:
+                cls.start(view, name, parameters, target)
+
+    @classmethod
+    def start(cls, view, name, parameters, target):
+        """ Run command `name` on `target` of `view`, in the background. """
+        limits = dict(parameters["limits"])
+        limits.update(SPECULATIVE_LIMITS)
+        job = Job(view, S_INSERT_REPLACE, name)
+        invoke_method = ExternalProgramCommand.get_invokation_method(
+            list(parameters["executable"]),
+            parameters["directory"],
+            parameters["through"],
+            parameters["output"],
+            S_INSERT_REPLACE,
+            parameters["fallback"],
+            limits,
+            parameters["filters"],
+            parameters["environment"],
+            job)
+        if invoke_method is None:
+            return
+
+        change_count = view.change_count()
+        text = view.substr(sublime.Region(*target))
+        cls.JOB = job
+
+        def thread():
+            speculated = invoke_method(text)
+
+            def store():
+                cls.JOB = None
+                (result, _stderr, return_code) = speculated
+                if (not job.aborted
+                        and view.id() in cls.PROFILES
+                        and result is not None
+                        and return_code == 0):
+                    cls.RESULTS.setdefault(view.id(), {})[name] = (
+                        change_count, target, speculated)
+                cls.next()
+
+            sublime.set_timeout(store, 0)
+
+        _thread.start_new_thread(thread, ())
+
+
+# Phantoms
+# ============================================================================
+
+PHANTOM_STYLE = '''
+    <style>
+        html.dark {
+            background-color: var(--yellowish);
+        }
+        html.light {
+            background-color: #88db7d;
+        }
+        body {
+            padding-right: 1rem;
+
+            color: black;
+        }
+        .hide {
+            color: black;
+
+            text-decoration: none;
+        }
+    </style>
+'''
+
+PHANTOM_TEMPLATE = (
+    "<body id='external-programs'>"
+        + PHANTOM_STYLE
+        + "<a class='hide' href='hide/%(id)i'>&nbsp;" + chr(0x00D7) + "&nbsp;</a>&nbsp;"
+        + "<span class='command-output'>%(output)s</span>"
+        + "%(expand)s"
+    + "</body>"
+)
+
+PHANTOM_EXPAND_TEMPLATE = (
+    "<br><a href='expand/%(id)i'>expand (%(hidden)i more characters)</a>")
+
+
+class Phantoms:
+
+    """ The phantoms of a view, in a single `sublime.PhantomSet`.
+
+    Phantoms are kept in least recently used order and the oldest ones are
+    removed when there are more than `phantom_limit`. A phantom added at
+    the same place as another one, replaces it.
+
+    Outputs longer than `phantom_preview_size` are first rendered truncated,
+    with an “expand” link, so that no huge HTML is built unless requested.
+
+    """
+
+    INSTANCES = {}  # View ID to `Phantoms`
+    IDS = itertools.count(1)
+
+    KEY = "external_programs"
+
+    def __init__(self, view):
+        """ Create an empty phantom set for `view`. """
+        self.view = view
+        self.phantom_set = sublime.PhantomSet(view, self.KEY)
+        self.entries = collections.OrderedDict()  # ID to `[phantom, text]`
+
+    @classmethod
+    def of_view(cls, view):
+        """ Return the single instance for `view`, created on demand. """
+        result = cls.INSTANCES.get(view.id())
+        if result is None:
+            result = cls(view)
+            cls.INSTANCES[view.id()] = result
+        return result
+
+    def region_of(self, phantom):
+        """ Return the current region of `phantom`, as moved by the edits. """
+        regions = self.view.query_phantom(phantom.id)
+        result = regions[0] if regions else phantom.region
+        return result
+
+    def render(self, phantom_id, text, expanded):
+        """ Return the HTML content of a phantom showing `text`. """
+        text = text.strip()
+        size = SETTINGS.get(S_PHANTOM_PREVIEW_SIZE, DEFAULT_PHANTOM_PREVIEW_SIZE)
+        expand = ""
+        if not expanded and len(text) > size:
+            expand = PHANTOM_EXPAND_TEMPLATE % {
+                "id": phantom_id,
+                "hidden": len(text) - size,
+            }
+            text = text[:size]
+
+        result = PHANTOM_TEMPLATE % {
+            "id": phantom_id,
+            "output": html.escape(text).replace("\n", "<br>"),
+            "expand": expand,
+        }
+        return result
+
+    def make(self, phantom_id, region, text, expanded=False):
+        """ Return a new phantom showing `text` at `region`. """
+        result = sublime.Phantom(
+            region,
+            self.render(phantom_id, text, expanded),
+            sublime.LAYOUT_BLOCK,
+            on_navigate=self.on_navigate)
+        return result
+
+    def add(self, region, text):
+        """ Show `text` in a phantom at `region`. """
+        for (phantom_id, (phantom, _text)) in list(self.entries.items()):
+            if self.region_of(phantom) == region:
+                del self.entries[phantom_id]
+
+        phantom_id = next(self.IDS)
+        self.entries[phantom_id] = [self.make(phantom_id, region, text), text]
+
+        limit = SETTINGS.get(S_PHANTOM_LIMIT, DEFAULT_PHANTOM_LIMIT)
+        while len(self.entries) > limit:
+            self.entries.popitem(last=False)
+
+        self.update()
+
+    def update(self):
+        """ Update the phantom set, unchanged phantoms being kept as is. """
+        self.phantom_set.update([phantom for (phantom, _text) in self.entries.values()])
+
+    def on_navigate(self, url):
+        """ Handle the “hide” and “expand” links. """
+        (action, _slash, phantom_id) = url.partition("/")
+        phantom_id = int(phantom_id)
+        entry = self.entries.get(phantom_id)
+        if entry is None:
+            return
+
+        if action == "hide":
+            del self.entries[phantom_id]
+        elif action == "expand":
+            (phantom, text) = entry
+            entry[0] = self.make(phantom_id, self.region_of(phantom), text, True)
+            self.entries.move_to_end(phantom_id)
+
+        self.update()
+
+
+# History
+# ============================================================================
+
+class History:
+
+    """ The last results of each command, to be recalled without running it.
+
+    Each command (after its `executable` before expansion) keeps its last
+    `history_size` results. Results are kept in memory up to
+    `history_memory` bytes for all the commands, beyond which the oldest are
+    written to compressed files in the cache directory, read back when
+    recalled. These files are for the session only.
+
+    An entry is a `dict` with `name`, `stdout`, `stderr`, `return_code`,
+    `started`, `duration`, `stats`, `size` (in memory), `memory` (if in
+    memory) and `file` (when written to disk, then `stdout` and `stderr` are
+    `None`; `None` when it could not be, then the output is lost).
+
+    """
+
+    ENTRIES = collections.OrderedDict()  # Name to `deque` of entries, last used last
+    MEMORY = collections.deque()  # Entries in memory, oldest first
+    MEMORY_SIZE = 0  # Bytes
+    LOCK = threading.Lock()  # Results are added from the worker threads
+    COUNTER = itertools.count()  # For file names
+
+    @staticmethod
+    def directory():
+        """ Return the directory where entries are written. """
+        return os.path.join(
+            sublime.cache_path(),
+            "External_Programs",
+            "History")
+
+    @classmethod
+    def add(cls, name, stdout, stderr, return_code, job):
+        """ Add a result of `name`, dropping or writing out older ones. """
+        stdout = stdout or ""
+        stderr = stderr or ""
+        entry = {
+            "name": name,
+            "stdout": stdout,
+            "stderr": stderr,
+            "return_code": return_code,
+            "started": job.started,
+            "duration": time.time() - job.started,
+            "stats": dict(job.stats),
+            "size": sys.getsizeof(stdout) + sys.getsizeof(stderr),
+            "memory": True,
+            "file": None,
+        }
+        size = SETTINGS.get(S_HISTORY_SIZE, DEFAULT_HISTORY_SIZE)
+        memory = SETTINGS.get(S_HISTORY_MEMORY, DEFAULT_HISTORY_MEMORY)
+
+        with cls.LOCK:
+            entries = cls.ENTRIES.pop(name, None)
+            if entries is None:
+                entries = collections.deque()
+            cls.ENTRIES[name] = entries
+            entries.append(entry)
+            cls.MEMORY.append(entry)
+            cls.MEMORY_SIZE += entry["size"]
+
+            while len(entries) > max(size, 0):
+                cls.drop(entries.popleft())
+            if not entries:
+                del cls.ENTRIES[name]
+
+            while cls.MEMORY_SIZE > memory and cls.MEMORY:
+                cls.spill(cls.MEMORY[0])
+
+    @classmethod
+    def drop(cls, entry):
+        """ Forget `entry`, wherever it is. """
+        if entry["memory"]:
+            cls.MEMORY.remove(entry)
+            cls.MEMORY_SIZE -= entry["size"]
+        elif entry["file"] is not None:
+            try:
+                os.unlink(entry["file"])
+            except OSError:
+                pass
+
+    @classmethod
+    def spill(cls, entry):
+        """ Write `entry` to a compressed file, leaving the memory. """
+        cls.MEMORY.remove(entry)
+        cls.MEMORY_SIZE -= entry["size"]
+        entry["memory"] = False
+        path = os.path.join(cls.directory(), "%i.json.gz" % next(cls.COUNTER))
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Fast rather than small: this is on the worker thread.
+            with gzip.open(path, "wt", compresslevel=1, encoding="utf-8") as file:
+                json.dump([entry["stdout"], entry["stderr"]], file)
+        except OSError as error:
+            # Rather lose the output than the memory.
+            print("Could not write history entry: %r" % error)
+            path = None
+            entry["stdout"] = ""
+            entry["stderr"] = "[lost]"
+        else:
+            entry["stdout"] = None
+            entry["stderr"] = None
+        entry["file"] = path
+
+    @staticmethod
+    def load(entry):
+        """ Return `(stdout, stderr)` of `entry`, or `None` on error. """
+        result = None
+        if entry["file"] is None:
+            result = (entry["stdout"], entry["stderr"])
+        else:
+            try:
+                with gzip.open(entry["file"], "rt", encoding="utf-8") as file:
+                    result = tuple(json.load(file))
+            except (OSError, ValueError) as error:
+                print("Could not read history entry: %r" % error)
+        return result
+
+    @classmethod
+    def names(cls):
+        """ Return the names of the commands with results, last used first. """
+        with cls.LOCK:
+            return list(reversed(cls.ENTRIES))
+
+    @classmethod
+    def entries(cls, name):
+        """ Return the entries of `name`, last first. """
+        with cls.LOCK:
+            return list(reversed(cls.ENTRIES.get(name, [])))
+
+    @classmethod
+    def remove_files(cls):
+        """ Remove the entries written by a previous session. """
+        for path in glob.glob(os.path.join(cls.directory(), "*.json.gz")):
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+
+# ### `external_program_history`
+
+class ExternalProgramHistory(sublime_plugin.WindowCommand):
+
+    """ Command to recall a past result, from quick panels.
+
+    A command, one of its results, and what to do with it are chosen in turn:
+    show it in the output and errors panels, or write it to the selection,
+    as `destination: insert_replace` would.
+
+    """
+
+    ACTIONS = [
+        ["Show in the panels", "Output and errors, as they were"],
+        ["Apply to the selection", "Insert or replace, without running the program"],
+    ]
+
+    def __init__(self, arg2):
+        """ Just invoke the parent class constructor. """
+        super().__init__(arg2)
+
+    def run(self):
+        """ Let the user choose a command, then go on with `choose_entry`. """
+        names = History.names()
+        if not names:
+            sublime.status_message("No result so far.")
+            return
+
+        def on_done(index):
+            if index != -1:
+                self.choose_entry(names[index])
+
+        self.window.show_quick_panel(
+            [[name, "%i result(s)" % len(History.entries(name))] for name in names],
+            on_done)
+
+    def choose_entry(self, name):
+        """ Let the user choose a result, then go on with `choose_action`. """
+        entries = History.entries(name)
+        items = []
+        for entry in entries:
+            stdout = entry["stdout"]  # May be written out meanwhile
+            first_line = stdout.split("\n", 1)[0] if stdout else ""
+            items.append([
+                first_line or "[%s]" % ("on disk" if entry["file"] else "no output"),
+                "%s, %.2f s, return code %s" % (
+                    time.strftime("%H:%M:%S", time.localtime(entry["started"])),
+                    entry["duration"],
+                    entry["return_code"])])
+
+        def on_done(index):
+            if index != -1:
+                self.choose_action(entries[index])
+
+        # One quick panel can't be shown while another closes.
+        sublime.set_timeout(lambda: self.window.show_quick_panel(items, on_done), 0)
+
+    def choose_action(self, entry):
+        """ Let the user choose what to do with `entry`. """
+
+        def on_done(index):
+            if index == 0:
+                self.show(entry)
+            elif index == 1:
+                self.apply(entry)
+
+        sublime.set_timeout(lambda: self.window.show_quick_panel(self.ACTIONS, on_done), 0)
+
+    def show(self, entry):
+        """ Write `entry` to the output and errors panels. """
+        texts = History.load(entry)
+        view = self.window.active_view()
+        if texts is None or view is None:
+            sublime.status_message("Error: could not recall the result")
+            return
+
+        (stdout, stderr) = texts
+        command = ExternalProgramCommand(view)
+        command.setup_panels(S_RESET)
+        command.get_output_panel_writer()(stdout or "[no output]")
+        if stderr:
+            command.write_error(stderr)
+
+    def apply(self, entry):
+        """ Write `entry` to the selection of the active view. """
+        texts = History.load(entry)
+        view = self.window.active_view()
+        if texts is None or view is None:
+            sublime.status_message("Error: could not recall the result")
+            return
+
+        sel = view.sel()
+        if len(sel) != 1:
+            sublime.status_message("Error: no selection or multiple selections")
+        elif not texts[0]:
+            sublime.status_message("Empty output.")
+        else:
+            region = sel[0]
+            view.run_command("run_external_program", {
+                "regions": [[region.begin(), region.end()]],
+                "results": [texts[0]],
+            })
+
+
+# Profiling
+# ============================================================================
+
+class Profiler:
+
+    """ Profile of a run, after `external_program_profile_next_run`.
+
+    The UI thread is profiled from when the command starts the program
+    until the result is written (this includes what other plug-ins do
+    meanwhile), and the worker thread, while it runs the program and writes
+    its result. When `tracemalloc` is available, allocations are traced
+    meanwhile, and a snapshot is taken at the end of each. A run which does
+    not start leaves the next one to be profiled.
+
+    The `.pstats` and snapshot files are written to the `profile_directory`
+    setting, and the `profile_top` first entries of each are written to the
+    output panel.
+
+    When no run is to be profiled, `take` returns a profiler doing nothing,
+    so that the command does not have to care.
+
+    """
+
+    ARMED = False  # If the next run is to be profiled
+    TITLES = {
+        "ui": "UI thread",
+        "worker": "Worker thread",
+    }
+
+    def __init__(self, active):
+        self.profiles = {}  # Section name to `cProfile.Profile`
+        self.snapshots = {}  # Section name to `tracemalloc.Snapshot`
+        self.tracing = False  # If `tracemalloc` was started for this
+        if active:
+            self.profiles = {
+                "ui": cProfile.Profile(),
+                "worker": cProfile.Profile(),
+            }
+            if tracemalloc is not None and not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self.tracing = True
+
+    @staticmethod
+    def available():
+        """ Tell if profiling is possible with this Python. """
+        return cProfile is not None
+
+    @classmethod
+    def arm(cls):
+        """ Have the next run profiled. """
+        cls.ARMED = True
+
+    @classmethod
+    def take(cls):
+        """ Return the profiler for a run, which may do nothing. """
+        active = cls.ARMED and cls.available()
+        cls.ARMED = False
+        return cls(active)
+
+    @staticmethod
+    def directory():
+        """ Return the directory where to write the profiles. """
+        result = SETTINGS.get(S_PROFILE_DIRECTORY, DEFAULT_PROFILE_DIRECTORY)
+        if result:
+            result = os.path.expanduser(result)
+        else:
+            result = os.path.join(
+                sublime.cache_path(),
+                "External_Programs",
+                "Profiles")
+        return result
+
+    def start(self, section):
+        """ Start profiling `section`, from the thread running it. """
+        profile = self.profiles.get(section)
+        if profile is not None:
+            profile.enable()
+
+    def stop(self, section):
+        """ Stop profiling `section`, from the thread running it. """
+        profile = self.profiles.get(section)
+        if profile is not None:
+            profile.disable()
+            if tracemalloc is not None and tracemalloc.is_tracing():
+                self.snapshots[section] = tracemalloc.take_snapshot()
+
+    def finish(self, name, write):
+        """ Write the profiles of `name` and their summary with `write`.
+
+        To be invoked from the UI thread, once the worker thread is done.
+
+        """
+        if not self.profiles:
+            return
+
+        self.stop("ui")
+        peak = None
+        if self.tracing:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+        directory = self.directory()
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        summary = io.StringIO()
+        summary.write("Profile of `%s`\n" % name)
+        try:
+            os.makedirs(directory, exist_ok=True)
+            for (section, profile) in sorted(self.profiles.items()):
+                profile.dump_stats(os.path.join(
+                    directory, "%s-%s.pstats" % (stamp, section)))
+            for (section, snapshot) in sorted(self.snapshots.items()):
+                snapshot.dump(os.path.join(
+                    directory, "%s-%s.tracemalloc" % (stamp, section)))
+            summary.write("Written to %s\n" % directory)
+        except OSError as error:
+            summary.write("Could not write profiles: %r\n" % error)
+
+        top = SETTINGS.get(S_PROFILE_TOP, DEFAULT_PROFILE_TOP)
+        for (section, profile) in sorted(self.profiles.items()):
+            summary.write("\n# %s\n" % self.TITLES[section])
+            stats = pstats.Stats(profile, stream=summary)
+            stats.sort_stats("cumulative").print_stats(top)
+
+        if peak is not None:
+            summary.write("\n# Allocations (peak: %i bytes)\n" % peak)
+        for (section, snapshot) in sorted(self.snapshots.items()):
+            summary.write("\n## %s\n" % self.TITLES[section])
+            # The plug-in's own allocations.
+            snapshot = snapshot.filter_traces([tracemalloc.Filter(True, __file__)])
+            for statistic in snapshot.statistics("lineno")[:top]:
+                summary.write("%s\n" % statistic)
+
+        write(summary.getvalue())
+
+
+# ### `external_program_profile_next_run`
+
+class ExternalProgramProfileNextRun(sublime_plugin.ApplicationCommand):
+
+    """ Command to profile the next `external_program` run. """
+
+    def run(self):
+        """ Have the next run profiled, if possible. """
+        if Profiler.available():
+            Profiler.arm()
+            sublime.status_message("The next run is profiled.")
+        else:
+            sublime.status_message("Error: profiling is not available.")
+
+
 # Load-time
 # ============================================================================
 
@@ -1005,3 +3496,9 @@ def plugin_loaded():
     OUTPUT_PANEL_NAME = SETTINGS.get(  # Change requires restart
         S_OUTPUT_PANEL_NAME,
         DEFAULT_OUTPUT_PANEL_NAME)
+
+    Environment.load()
+    Environment.refresh()
+
+    ExternalProgramCommand.remove_temporary_files()
+    History.remove_files()
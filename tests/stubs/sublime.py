@@ -0,0 +1,116 @@
+""" Stand-in for the Sublime Text `sublime` module, for headless tests.
+
+Only what `external_programs` needs to run programs is provided: settings,
+paths and the status bar. Callbacks given to `set_timeout` are queued, see
+`run_timeouts`.
+
+"""
+
+import os
+import tempfile
+
+
+HIDDEN = 1
+DRAW_NO_FILL = 32
+DRAW_NO_OUTLINE = 256
+DRAW_SQUIGGLY_UNDERLINE = 2048
+LAYOUT_BLOCK = 1
+ENCODED_POSITION = 1
+
+ROOT = tempfile.mkdtemp(prefix="external-programs-tests-")
+PACKAGES = os.path.join(ROOT, "Packages")
+CACHE = os.path.join(ROOT, "Cache")
+os.makedirs(PACKAGES)
+os.makedirs(CACHE)
+
+SETTINGS = {}  # File name to `Settings`
+TIMEOUTS = []  # Callbacks from `set_timeout`
+MESSAGES = []  # From `status_message`
+
+
+class Settings(dict):
+
+    """ Settings, as a `dict` with the Sublime Text methods. """
+
+    def get(self, key, default=None):
+        return dict.get(self, key, default)
+
+    def set(self, key, value):
+        self[key] = value
+
+    def erase(self, key):
+        self.pop(key, None)
+
+
+class Region:
+
+    """ Region, with what is used on programs' results. """
+
+    def __init__(self, a, b=None):
+        self.a = a
+        self.b = a if b is None else b
+
+    def begin(self):
+        return min(self.a, self.b)
+
+    def end(self):
+        return max(self.a, self.b)
+
+    def empty(self):
+        return self.a == self.b
+
+    def size(self):
+        return self.end() - self.begin()
+
+    def __eq__(self, other):
+        return (self.a, self.b) == (other.a, other.b)
+
+
+class Phantom:
+
+    def __init__(self, region, content, layout, on_navigate=None):
+        self.region = region
+        self.content = content
+
+
+class PhantomSet:
+
+    def __init__(self, view, key=""):
+        self.phantoms = []
+
+    def update(self, phantoms):
+        self.phantoms = list(phantoms)
+
+
+def load_settings(name):
+    return SETTINGS.setdefault(name, Settings())
+
+
+def packages_path():
+    return PACKAGES
+
+
+def cache_path():
+    return CACHE
+
+
+def platform():
+    return "windows" if os.name == "nt" else "linux"
+
+
+def expand_variables(value, variables):
+    return value
+
+
+def status_message(message):
+    MESSAGES.append(message)
+
+
+def set_timeout(callback, delay=0):
+    TIMEOUTS.append(callback)
+
+
+def run_timeouts():
+    """ Run the queued callbacks, as the UI thread would. """
+    while TIMEOUTS:
+        TIMEOUTS.pop(0)()
@@ -0,0 +1,21 @@
+""" Stand-in for the Sublime Text `sublime_plugin` module, for headless tests. """
+
+
+class TextCommand:
+
+    def __init__(self, view):
+        self.view = view
+
+
+class WindowCommand:
+
+    def __init__(self, window):
+        self.window = window
+
+
+class ApplicationCommand:
+    pass
+
+
+class EventListener:
+    pass
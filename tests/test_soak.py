@@ -0,0 +1,347 @@
+""" Soak and leak tests for running programs, without Sublime Text.
+
+Thousands of mixed invocations (normal, crashing, timing out, aborted, with
+huge or invalid output, detached) go through `get_invokation_method` and
+`Pump`, after which the file descriptors, threads, child processes and
+temporary files of the test process must be back to what they were. A
+throughput report is printed, by batches of invocations and by kind.
+
+The `sublime` and `sublime_plugin` modules are stubs, see `stubs`. This
+needs `/proc`, so Linux. From the repository root:
+
+    python -m unittest discover -s tests
+
+The number of invocations is after the `EXTERNAL_PROGRAMS_SOAK` environment
+variable, 2000 by default.
+
+"""
+
+import collections
+import glob
+import os
+import random
+import shutil
+import sys
+import threading
+import time
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "stubs"))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import sublime  # noqa: E402 (stub)
+import external_programs as ep  # noqa: E402
+
+SOAK_SIZE = int(os.environ.get("EXTERNAL_PROGRAMS_SOAK", "2000"))
+BATCH_SIZE = 200  # Invocations per line of the throughput report
+SHORT_TIMEOUT = 0.2  # Seconds, for programs meant to time out
+TIMEOUT = 10  # Seconds, for the others
+SESSIONS = set()  # Process IDs of the programs, which lead their session
+
+
+def setUpModule():
+    settings = sublime.load_settings(ep.SETTINGS_FILE)
+    settings.set(ep.S_LOGIN_SHELL_ENVIRONMENT, False)
+    ep.plugin_loaded()
+
+
+def tearDownModule():
+    shutil.rmtree(sublime.ROOT, ignore_errors=True)
+
+
+class View:
+
+    """ What a `Job` needs of a view. """
+
+    def change_count(self):
+        return 0
+
+
+def invoke(executable, through=None, text="", output="stdout",
+           destination=ep.S_OUTPUT_PANEL, fallback=ep.S_STDIN, limits=None,
+           filters=None, timeout=TIMEOUT, job=None):
+    """ Run `executable` as `external_program` would, return `(result, job)`.
+
+    `result` is `(stdout, stderr, return_code)`.
+
+    """
+    ep.SETTINGS.set(ep.S_TIMEOUT_DELAY, timeout)
+    if job is None:
+        job = ep.Job(View(), destination, executable)
+    method = ep.ExternalProgramCommand.get_invokation_method(
+        [executable], sublime.packages_path(), through, output, destination,
+        fallback, limits or {}, filters, dict(os.environ), job)
+    result = method(text)
+    if job.process is not None:
+        SESSIONS.add(job.process.pid)
+    for process in ep.ExternalProgramCommand.DETACHED:
+        SESSIONS.add(process.pid)
+    return (result, job)
+
+
+def processes():
+    """ Return `(pid, ppid, session, state)` of the processes. """
+    result = []
+    for path in glob.glob("/proc/[0-9]*/stat"):
+        try:
+            with open(path) as file:
+                stat = file.read()
+        except OSError:
+            continue
+        # The command name may have spaces, but is in parentheses.
+        fields = stat[stat.rindex(")") + 2:].split()
+        result.append((
+            int(path.split("/")[2]),
+            int(fields[1]),
+            int(fields[3]),
+            fields[0]))
+    return result
+
+
+def running():
+    """ Return the processes the programs left, see `leftovers`. """
+    children = []
+    for (pid, ppid, session, state) in processes():
+        # Dead processes out of the test process are for `init` to reap.
+        if ppid == os.getpid() or (session in SESSIONS and state != "Z"):
+            children.append((pid, ppid, session, state))
+    return sorted(children)
+
+
+def leftovers():
+    """ Return what the programs may leak, to compare with a baseline. """
+    return {
+        "file descriptors": sorted(os.listdir("/proc/self/fd")),
+        "threads": sorted(thread.name for thread in threading.enumerate()),
+        "processes": running(),
+        "temporary files": sorted(glob.glob(os.path.join(
+            sublime.packages_path(),
+            ep.TEMPORARY_FILE_PREFIX + "*" + ep.TEMPORARY_FILE_SUFFIX))),
+    }
+
+
+def settle():
+    """ Wait for detached programs to end and reap them, for killed
+    processes to be gone, and for the threads writing to them to end. """
+    deadline = time.time() + TIMEOUT
+    while ep.ExternalProgramCommand.DETACHED and time.time() < deadline:
+        ep.ExternalProgramCommand.reap()
+        time.sleep(0.01)
+    # A killed process out of the test process may take a moment to exit.
+    while running() and time.time() < deadline:
+        time.sleep(0.01)
+    while threading.active_count() > 1 and time.time() < deadline:
+        time.sleep(0.01)
+    sublime.run_timeouts()
+
+
+# Invocations
+# ============================================================================
+#
+# Each takes a `random.Random` and checks its own result; the weight is how
+# often it comes in the soak.
+
+def run_stdin(rng):
+    text = "".join(rng.choice("abc\n") for _ in range(rng.randint(1, 65536)))
+    ((stdout, stderr, code), job) = invoke("cat", ep.S_STDIN, text)
+    assert (stdout, stderr, code) == (text, "", 0), (stdout[:80], stderr, code)
+
+
+def run_argument(rng):
+    ((stdout, stderr, code), job) = invoke(
+        'printf %s "$0"', ep.S_SINGLE_ARGUMENT, "argument")
+    assert (stdout, code) == ("argument", 0), (stdout, stderr, code)
+
+
+def run_argument_fallback(rng):
+    fallback = rng.choice([ep.S_TEMPORARY_FILE, ep.S_DEV_FD])
+    ((stdout, stderr, code), job) = invoke(
+        'wc -c < "$0"', ep.S_SINGLE_ARGUMENT, "x" * 300000, fallback=fallback)
+    assert (stdout.strip(), code) == ("300000", 0), (stdout, stderr, code)
+    assert job.stats["channel"] == fallback, job.stats
+
+
+def run_temporary_file_output(rng):
+    ((stdout, stderr, code), job) = invoke(
+        'tr a-z A-Z < "$0" > "$0.out" && mv "$0.out" "$0"',
+        ep.S_TEMPORARY_FILE, "text", output=ep.S_TEMPORARY_FILE)
+    assert (stdout, code) == ("TEXT", 0), (stdout, stderr, code)
+
+
+def run_crash(rng):
+    ((stdout, stderr, code), job) = invoke(
+        rng.choice(["echo partial; kill -SEGV $$", "echo failed >&2; exit 3"]))
+    assert code in (-11, 3), (stdout, stderr, code)
+
+
+def run_timeout(rng):
+    # With a child of the shell holding the pipes open, or not.
+    ((stdout, stderr, code), job) = invoke(
+        rng.choice(["sleep 10", "sleep 10 & sleep 10", "echo err >&2; sleep 10"]),
+        timeout=SHORT_TIMEOUT)
+    assert (stdout, code) == (None, None), (stdout, stderr, code)
+
+
+def run_abort(rng):
+    # As `Speculation.cancel` does.
+    job = ep.Job(View(), ep.S_OUTPUT_PANEL, "abort")
+    results = []
+    thread = threading.Thread(
+        target=lambda: results.append(invoke("yes", job=job)[0]))
+    thread.start()
+    while job.process is None and thread.is_alive():
+        time.sleep(0.001)
+    if job.process is not None:
+        ep.ExternalProgramCommand.kill(job.process)
+    thread.join()
+    assert results and results[0][2] in (-9, None), results[0][1:]
+
+
+class FailingPump(ep.Pump):
+
+    """ A `Pump` failing before it runs, once the program started. """
+
+    def __init__(self, *args, **kwargs):
+        raise RuntimeError("failing pump")
+
+
+def run_failure(rng):
+    # An error out of `Pump.run`, handled by `on_error`.
+    ep.Pump = FailingPump
+    try:
+        ((stdout, stderr, code), job) = invoke("cat", ep.S_STDIN, "text")
+    finally:
+        ep.Pump = FailingPump.__bases__[0]
+    assert (stdout, code) == (None, None), (stdout, stderr, code)
+    assert job.process is None, job.process
+
+
+def run_huge(rng):
+    ((stdout, stderr, code), job) = invoke(
+        "yes | head -c 8000000", limits={ep.S_MAX_OUTPUT: 1000000})
+    assert len(stdout) <= 1000000 and job.stats.get("truncated"), len(stdout)
+
+
+def run_invalid_utf8(rng):
+    ((stdout, stderr, code), job) = invoke(
+        rng.choice([
+            "printf '\\377\\376'; printf '\\377' >&2",
+            "printf '\\377\\376'; sleep 10"]),
+        timeout=SHORT_TIMEOUT)
+    assert code in (0, None), (stdout, stderr, code)
+
+
+def run_detached(rng):
+    if rng.random() < 0.5:
+        ((stdout, stderr, code), job) = invoke("true", destination=None)
+    else:
+        # With the text written to `/dev/fd` from a thread.
+        ((stdout, stderr, code), job) = invoke(
+            'cat "$0" > /dev/null', ep.S_SINGLE_ARGUMENT, "x" * 300000,
+            destination=None, fallback=ep.S_DEV_FD)
+        assert job.stats["channel"] == ep.S_DEV_FD, job.stats
+    assert code == 0, (stdout, stderr, code)
+
+
+def run_progress_and_filters(rng):
+    ((stdout, stderr, code), job) = invoke(
+        "echo PROGRESS 1/2 >&2; echo err >&2; seq 1 1000",
+        filters=[{"tail": 2}])
+    assert (stdout, stderr, code) == ("999\n1000\n", "err\n", 0), (stdout, stderr, code)
+    assert job.progress == (1, 2), job.progress
+
+
+INVOCATIONS = [
+    (run_stdin, 20),
+    (run_argument, 15),
+    (run_argument_fallback, 5),
+    (run_temporary_file_output, 10),
+    (run_crash, 10),
+    (run_timeout, 2),
+    (run_abort, 5),
+    (run_failure, 2),
+    (run_huge, 3),
+    (run_invalid_utf8, 3),
+    (run_detached, 5),
+    (run_progress_and_filters, 10),
+]
+
+
+# Tests
+# ============================================================================
+
+@unittest.skipUnless(os.path.isdir("/proc/self/fd"), "needs /proc")
+class SoakTest(unittest.TestCase):
+
+    """ Run programs in every way, and check nothing is left behind. """
+
+    def setUp(self):
+        # Warm up what is created once, like the shell lookup.
+        run_stdin(random.Random(0))
+        settle()
+        self.baseline = leftovers()
+
+    def assertNoLeak(self):
+        settle()
+        after = leftovers()
+        for key in self.baseline:
+            self.assertEqual(self.baseline[key], after[key], "leaked %s" % key)
+
+    def test_each(self):
+        """ Each kind of invocation leaks nothing on its own. """
+        rng = random.Random(1)
+        for (method, _weight) in INVOCATIONS:
+            for _ in range(3):
+                method(rng)
+            with self.subTest(method.__name__):
+                self.assertNoLeak()
+
+    def test_soak(self):
+        """ Thousands of mixed invocations leak nothing, report throughput. """
+        rng = random.Random(2)
+        methods = [method for (method, weight) in INVOCATIONS for _ in range(weight)]
+        times = collections.defaultdict(list)
+        batches = []  # `(first, last, seconds)`, to tell a slowdown over time
+        started = batch_started = time.time()
+        for index in range(SOAK_SIZE):
+            method = rng.choice(methods)
+            before = time.time()
+            method(rng)
+            times[method.__name__].append(time.time() - before)
+            if (index + 1) % BATCH_SIZE == 0 or index + 1 == SOAK_SIZE:
+                now = time.time()
+                first = index // BATCH_SIZE * BATCH_SIZE + 1
+                batches.append((first, index + 1, now - batch_started))
+                batch_started = now
+        elapsed = time.time() - started
+        self.assertNoLeak()
+
+        print("\n%i invocations in %.1f s, %.0f per second" % (
+            SOAK_SIZE, elapsed, SOAK_SIZE / elapsed))
+        for (first, last, seconds) in batches:
+            print("  invocations %5i to %-5i %5.0f per second" % (
+                first, last, (last - first + 1) / seconds))
+        for (name, durations) in sorted(times.items()):
+            print("  %-28s %5i  mean %7.1f ms  max %7.1f ms" % (
+                name, len(durations),
+                1000 * sum(durations) / len(durations),
+                1000 * max(durations)))
+
+    def test_output_throughput(self):
+        """ Report how fast output goes through `Pump`. """
+        size = 64 * 1024 * 1024
+        started = time.time()
+        ((stdout, stderr, code), job) = invoke(
+            "head -c %i /dev/zero | tr '\\0' x" % size,
+            limits={ep.S_MAX_OUTPUT: None})
+        elapsed = time.time() - started
+        self.assertEqual((len(stdout), code), (size, 0))
+        print("\n%i MiB of output in %.2f s, %.0f MiB/s" % (
+            size // 2 ** 20, elapsed, size / 2 ** 20 / elapsed))
+        del stdout
+        self.assertNoLeak()
+
+
+if __name__ == "__main__":
+    unittest.main()